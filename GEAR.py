@@ -1,7 +1,25 @@
 import libtcodpy as libtcod
 import math
 import textwrap
-import shelve
+import struct
+import os
+import threading
+import zlib
+import collections
+import multiprocessing
+import argparse
+import timeit
+import heapq
+import array
+import bisect
+import json
+import tempfile
+import shutil
+import atexit
+try:
+	import Queue as queue
+except ImportError:
+	import queue
 
 SCREEN_WIDTH = 100
 SCREEN_HEIGHT = 75
@@ -16,6 +34,9 @@ MAX_ROOMS = 30
 MAX_ROOM_MONSTERS = 3
 MAX_ROOM_ITEMS = 2
 
+#how levels get built, one of the names in GENERATORS
+MAP_GENERATOR = 'rooms'
+
 BAR_WIDTH = 20
 PANEL_HEIGHT = 7
 PANEL_Y = SCREEN_HEIGHT - PANEL_HEIGHT
@@ -26,47 +47,204 @@ FOV_ALGO = 0
 FOV_LIGHT_WALLS = True
 TORCH_RADIUS = 10
 
+#how often fighters get to act. one with speed 200 acts twice for every action
+#of a speed 100 one, and every action at NORMAL_SPEED takes ACTION_TIME ticks
+NORMAL_SPEED = 100
+ACTION_TIME = 1000
+
 MSG_X = BAR_WIDTH + 2
 MSG_WIDTH = SCREEN_WIDTH - BAR_WIDTH - 2
 MSG_HEIGHT = PANEL_HEIGHT - 1
 
 LIMIT_FPS = 20
 
-HEAL_AMOUNT = libtcod.random_get_int(0, 3, 6)
+#spell strengths are rolled from these ranges at the start of every game,
+#see roll_spell_powers()
+HEAL_AMOUNT_ROLL = (3, 6)
 CORRUPT_RANGE = 6
-CORRUPT_DAMAGE = libtcod.random_get_int(0, 10, 20)
-GLITCH_NUM_TURNS = libtcod.random_get_int(0, 7, 15)
+CORRUPT_DAMAGE_ROLL = (10, 20)
+GLITCH_NUM_TURNS_ROLL = (7, 15)
 GLITCH_RANGE = 8
-GRAV_RADIUS = libtcod.random_get_int(0, 2, 4)
-GRAV_DAMAGE = libtcod.random_get_int(0, 9, 15)
+GRAV_RADIUS_ROLL = (2, 4)
+GRAV_DAMAGE_ROLL = (9, 15)
+
+HEAL_AMOUNT = None
+CORRUPT_DAMAGE = None
+GLITCH_NUM_TURNS = None
+GRAV_RADIUS = None
+GRAV_DAMAGE = None
 
 color_dark_wall = libtcod.Color(31, 31, 31)
 color_light_wall = libtcod.Color(95, 95, 95)
 color_dark_ground = libtcod.Color(159, 159, 159)
 color_light_ground = libtcod.Color(127, 127, 127)
 
-LG = False
-LW = False
-DG = False
-DW = False
+#the look of every tile for each strobe setting. tiles are coded
+#0 unexplored, 1 dark ground, 2 dark wall, 3 lit ground, 4 lit wall.
+#each entry is (normal color, the 10 colors the distortion dice can turn it
+#into). dark tiles only roll a d5, so their five colors are listed twice,
+#and lit tiles keep their normal color on a roll above five
+def strobe_palette(dark_ground, dark_wall, lit_ground, lit_wall, dg, dw, lg, lw):
+	return ((libtcod.black, libtcod.black, libtcod.black, libtcod.black),
+		(dark_ground, tuple(dg) * 2),
+		(dark_wall, tuple(dw) * 2),
+		(lit_ground, tuple(lg) + (lit_ground,) * 5),
+		(lit_wall, tuple(lw) + (lit_wall,) * 5))
+
+strobe_green = strobe_palette(libtcod.dark_green, libtcod.darker_green, libtcod.light_green, libtcod.green,
+	[libtcod.yellow, libtcod.pink, libtcod.flame, libtcod.grey, libtcod.blue],
+	[libtcod.yellow, libtcod.pink, libtcod.flame, libtcod.grey, libtcod.blue],
+	[libtcod.yellow, libtcod.pink, libtcod.flame, libtcod.grey, libtcod.blue],
+	[libtcod.yellow, libtcod.pink, libtcod.flame, libtcod.grey, libtcod.blue])
+strobe_blue = strobe_palette(libtcod.dark_blue, libtcod.darker_blue, libtcod.light_blue, libtcod.blue,
+	[libtcod.yellow, libtcod.pink, libtcod.flame, libtcod.grey, libtcod.green],
+	[libtcod.yellow, libtcod.pink, libtcod.flame, libtcod.grey, libtcod.green],
+	[libtcod.yellow, libtcod.pink, libtcod.flame, libtcod.grey, libtcod.green],
+	[libtcod.yellow, libtcod.pink, libtcod.flame, libtcod.grey, libtcod.green])
+strobe_flame = strobe_palette(libtcod.dark_flame, libtcod.darker_flame, libtcod.light_flame, libtcod.flame,
+	[libtcod.yellow, libtcod.pink, libtcod.blue, libtcod.grey, libtcod.green],
+	[libtcod.yellow, libtcod.pink, libtcod.blue, libtcod.grey, libtcod.green],
+	[libtcod.yellow, libtcod.pink, libtcod.green, libtcod.grey, libtcod.blue],
+	[libtcod.yellow, libtcod.pink, libtcod.green, libtcod.grey, libtcod.blue])
+strobe_pink = strobe_palette(libtcod.dark_pink, libtcod.darker_pink, libtcod.light_pink, libtcod.pink,
+	[libtcod.yellow, libtcod.blue, libtcod.flame, libtcod.grey, libtcod.green],
+	[libtcod.yellow, libtcod.blue, libtcod.flame, libtcod.grey, libtcod.green],
+	[libtcod.yellow, libtcod.green, libtcod.flame, libtcod.grey, libtcod.blue],
+	[libtcod.yellow, libtcod.green, libtcod.flame, libtcod.grey, libtcod.blue])
+strobe_normal = strobe_palette(color_dark_ground, color_dark_wall, color_light_ground, color_light_wall,
+	[libtcod.yellow, libtcod.pink, libtcod.flame, libtcod.grey, libtcod.green],
+	[libtcod.yellow, libtcod.pink, libtcod.flame, libtcod.blue, libtcod.green],
+	[libtcod.yellow, libtcod.pink, libtcod.flame, libtcod.green, libtcod.blue],
+	[libtcod.yellow, libtcod.pink, libtcod.flame, libtcod.green, libtcod.blue])
+
+#indexed by strobe (1-10)
+PALETTES = [None, strobe_green, strobe_blue, strobe_flame, strobe_pink] + [strobe_normal] * 6
 
 distortion = 0
 max_dist = 10000
 
+#headless runs have no root console: nothing is blitted or flushed to the screen,
+#and keys come from input_source instead of the keyboard and mouse
+headless = False
+input_source = None
 
-class Tile:
-	#a tile of the map and its properties
-	def __init__(self, blocked, block_sight = None):
-		self.blocked = blocked
-		
-		self.explored = False
+#each part of the game rolls its own dice, seeded from the game seed by
+#seed_rngs(), so how often the screen gets redrawn can't change how a fight
+#goes and a game can be played again from its seed. the dungeon itself is
+#built with gen_rng, seeded per level (see level_seed()). until a game is
+#started they all use libtcod's default generator
+combat_rng = 0
+ai_rng = 0
+render_rng = 0
+flavor_rng = 0
+
+
+class Map(object):
+	#the whole floor. instead of a Tile object per square, every property is
+	#stored packed in its own flat byte array (one byte per tile, row by row)
+	def __init__(self, width, height, blocked=True):
+		self.width = width
+		self.height = height
 		
 		#by default, if a tile is blocked, it also blocks sight
-		if block_sight is None: block_sight = blocked
-		self.block_sight = block_sight
+		fill = 1 if blocked else 0
+		self.blocked = bytearray([fill]) * (width * height)
+		self.block_sight = bytearray(self.blocked)
+		self.explored = bytearray(width * height)
+		
+		#goes up every time a tile changes whether it blocks, so anything worked
+		#out from the walls knows when it's out of date
+		self.version = 0
+		
+	def index(self, x, y):
+		#position of the tile (x, y) inside the packed arrays
+		return x + y * self.width
+		
+	def carve_rect(self, x1, y1, x2, y2):
+		#make every tile from (x1, y1) to (x2, y2), edges included, passable and
+		#see-through, a whole row at a time
+		if x1 > x2 or y1 > y2:
+			return
+		w = self.width
+		row = bytearray(x2 - x1 + 1)
+		for y in range(y1, y2 + 1):
+			i = x1 + y * w
+			self.blocked[i:i + len(row)] = row
+			self.block_sight[i:i + len(row)] = row
+		self.version += 1
+		
+	def set_walls(self, walls):
+		#replace every tile at once from a packed grid, 1 for wall and 0 for floor
+		self.blocked[:] = walls
+		self.block_sight[:] = walls
+		self.version += 1
+		
+	def carve_column(self, x, y1, y2):
+		#the same for the tiles from (x, y1) down to (x, y2), which are a row
+		#apart in the arrays, so it's one strided slice
+		w = self.width
+		column = bytearray(y2 - y1 + 1)
+		self.blocked[x + y1 * w:x + y2 * w + 1:w] = column
+		self.block_sight[x + y1 * w:x + y2 * w + 1:w] = column
+		self.version += 1
+		
+	def __getitem__(self, x):
+		#so the old map[x][y].blocked style still works
+		return MapColumn(self, x)
+		
+	def __len__(self):
+		return self.width
+		
+class MapColumn(object):
+	__slots__ = ('map', 'x')
+	
+	def __init__(self, map, x):
+		self.map = map
+		self.x = x
+		
+	def __getitem__(self, y):
+		return Tile(self.map, self.map.index(self.x, y))
+		
+	def __len__(self):
+		return self.map.height
 		
+class Tile(object):
+	#a tile of the map and its properties. this is only a view into the
+	#packed Map arrays, so writing to it changes the map
+	__slots__ = ('map', 'i')
+	
+	def __init__(self, map, i):
+		self.map = map
+		self.i = i
 		
-class Rect:
+	def _get_blocked(self):
+		return self.map.blocked[self.i] == 1
+		
+	def _set_blocked(self, value):
+		self.map.blocked[self.i] = 1 if value else 0
+		self.map.version += 1
+		
+	def _get_block_sight(self):
+		return self.map.block_sight[self.i] == 1
+		
+	def _set_block_sight(self, value):
+		self.map.block_sight[self.i] = 1 if value else 0
+		self.map.version += 1
+		
+	def _get_explored(self):
+		return self.map.explored[self.i] == 1
+		
+	def _set_explored(self, value):
+		self.map.explored[self.i] = 1 if value else 0
+		
+	blocked = property(_get_blocked, _set_blocked)
+	block_sight = property(_get_block_sight, _set_block_sight)
+	explored = property(_get_explored, _set_explored)
+		
+		
+class Rect(object):
+	__slots__ = ('x1', 'y1', 'x2', 'y2')
+	
 	def __init__(self, x, y, w, h):
 		self.x1 = x
 		self.y1 = y
@@ -82,10 +260,245 @@ class Rect:
 		return (self.x1 <= other.x2 and self.x2 >= other.x1 and
 			self.y1 <= other.y2 and self.y2 >= other.y1)
 		
-class Object:
+def oid_of(obj):
+	return obj.oid
+	
+#what gets drawn over what when several objects share a tile, bottom to top
+LAYER_REMAINS = 0 #corpses and stairs
+LAYER_ITEM = 1
+LAYER_ACTOR = 2
+LAYER_PLAYER = 3
+
+def render_layer(obj):
+	if obj is player:
+		return LAYER_PLAYER
+	if obj.fighter:
+		return LAYER_ACTOR
+	if obj.item:
+		return LAYER_ITEM
+	return LAYER_REMAINS
+	
+class SpatialIndex(object):
+	#keeps track of what is standing on each tile, so asking "who is at (x, y)?"
+	#doesn't mean going through the whole objects list. it also knows which of
+	#the objects have a fighter or an AI, so the code that only cares about those
+	#doesn't have to look at every item and corpse on the floor either
+	def __init__(self):
+		self.cells = {} #(x, y) -> list of objects on that tile, bottom layer first
+		self.blocking = {} #(x, y) -> how many blocking objects are on that tile
+		self.fighters = set() #objects on the map with a fighter component
+		self.thinkers = set() #objects on the map with an AI component
+		
+	def rebuild(self, objects):
+		self.cells = {}
+		self.blocking = {}
+		self.fighters = set()
+		self.thinkers = set()
+		for obj in objects:
+			self.add(obj)
+		
+	def add(self, obj):
+		pos = (obj.x, obj.y)
+		self._stack(obj)
+		if obj.blocks:
+			self.blocking[pos] = self.blocking.get(pos, 0) + 1
+		if obj.fighter:
+			self.fighters.add(obj)
+		if obj.ai:
+			self.thinkers.add(obj)
+			
+	def remove(self, obj):
+		pos = (obj.x, obj.y)
+		self._unstack(obj)
+		if obj.blocks:
+			self._unblock(pos)
+		self.fighters.discard(obj)
+		self.thinkers.discard(obj)
+		
+	def _stack(self, obj):
+		#put the object on top of its own layer on its tile, under anything in a
+		#higher one, so the cells are always in draw order
+		pos = (obj.x, obj.y)
+		cell = self.cells.get(pos)
+		if cell is None:
+			self.cells[pos] = [obj]
+			return
+		layer = render_layer(obj)
+		i = len(cell)
+		while i and render_layer(cell[i - 1]) > layer:
+			i -= 1
+		cell.insert(i, obj)
+		
+	def _unstack(self, obj):
+		pos = (obj.x, obj.y)
+		cell = self.cells[pos]
+		cell.remove(obj)
+		if not cell:
+			del self.cells[pos]
+			
+	def _unblock(self, pos):
+		count = self.blocking[pos] - 1
+		if count:
+			self.blocking[pos] = count
+		else:
+			del self.blocking[pos]
+			
+	def move(self, obj, x, y):
+		#move an object that is on the map to a new tile
+		self.remove(obj)
+		obj.x = x
+		obj.y = y
+		self.add(obj)
+		
+	def set_blocks(self, obj, blocks):
+		#change whether an object on the map blocks its tile
+		if obj.blocks == blocks:
+			return
+		pos = (obj.x, obj.y)
+		if blocks:
+			self.blocking[pos] = self.blocking.get(pos, 0) + 1
+		else:
+			self._unblock(pos)
+		obj.blocks = blocks
+		
+	def set_fighter(self, obj, fighter):
+		#give an object on the map a fighter component, or take it away with None.
+		#that can move it to another layer, so it gets restacked on its tile
+		self._unstack(obj)
+		obj.fighter = fighter
+		if fighter:
+			fighter.owner = obj
+			self.fighters.add(obj)
+		else:
+			self.fighters.discard(obj)
+		self._stack(obj)
+			
+	def set_ai(self, obj, ai):
+		#the same for the AI component
+		obj.ai = ai
+		if ai:
+			ai.owner = obj
+			self.thinkers.add(obj)
+		else:
+			self.thinkers.discard(obj)
+		
+	def at(self, x, y):
+		#everything on the tile. don't change the returned list while looping over it
+		return self.cells.get((x, y), ())
+		
+	def cells_in_box(self, x1, y1, x2, y2):
+		#the occupied tiles in the rectangle, edges included. looks up each tile
+		#of a big rectangle, or goes through the occupied tiles if there are fewer
+		cells = self.cells
+		if len(cells) < (x2 - x1 + 1) * (y2 - y1 + 1):
+			return [cell for ((x, y), cell) in cells.items() if x1 <= x <= x2 and y1 <= y <= y2]
+		found = []
+		for y in range(y1, y2 + 1):
+			for x in range(x1, x2 + 1):
+				cell = cells.get((x, y))
+				if cell:
+					found.append(cell)
+		return found
+		
+	def in_box(self, x1, y1, x2, y2):
+		#everything standing in the rectangle, edges included
+		found = []
+		for cell in self.cells_in_box(x1, y1, x2, y2):
+			found.extend(cell)
+		return found
+		
+	def on_top_in_view(self):
+		#the object drawn on top of each tile the player can see. the rest are
+		#covered up, so they're not worth drawing
+		shown = []
+		for cell in self.cells_in_box(player.x - TORCH_RADIUS, player.y - TORCH_RADIUS,
+				player.x + TORCH_RADIUS, player.y + TORCH_RADIUS):
+			top = cell[-1]
+			if libtcod.map_is_in_fov(fov_map, top.x, top.y):
+				shown.append(top)
+		return shown
+
+	#the queries below only look at the tiles they could hit, so a spell costs
+	#about the same on a crowded level as on an empty one. distances are
+	#compared squared, no square roots
+
+	def in_radius(self, x, y, radius):
+		#everything within radius tiles of (x, y), oldest first
+		reach = radius * radius
+		found = [obj for obj in self.in_box(x - radius, y - radius, x + radius, y + radius)
+			if (obj.x - x) ** 2 + (obj.y - y) ** 2 <= reach]
+		found.sort(key=oid_of)
+		return found
+
+	def nearest(self, x, y, max_range, k=1, exclude=None):
+		#the k living things closest to (x, y) that the player can see, no
+		#further than max_range, closest first (and oldest first on a tie)
+		reach = (max_range + 1) ** 2
+		if len(self.fighters) < (2 * max_range + 1) ** 2:
+			candidates = self.fighters
+		else:
+			candidates = self.in_box(x - max_range, y - max_range, x + max_range, y + max_range)
+		found = []
+		for obj in candidates:
+			if not obj.fighter or obj is exclude:
+				continue
+			dist = (obj.x - x) ** 2 + (obj.y - y) ** 2
+			if dist < reach and libtcod.map_is_in_fov(fov_map, obj.x, obj.y):
+				found.append((dist, obj.oid, obj))
+		found.sort()
+		return [obj for (dist, oid, obj) in found[:k]]
+
+	def in_cone(self, x, y, target_x, target_y, radius, half_angle):
+		#everything within radius of (x, y) and no more than half_angle degrees
+		#off the direction towards (target_x, target_y), oldest first
+		aim_x = target_x - x
+		aim_y = target_y - y
+		aim = aim_x ** 2 + aim_y ** 2
+		spread = math.cos(math.radians(half_angle)) ** 2
+		found = []
+		for obj in self.in_radius(x, y, radius):
+			dx = obj.x - x
+			dy = obj.y - y
+			dot = dx * aim_x + dy * aim_y
+			if dot > 0 and dot * dot >= spread * aim * (dx ** 2 + dy ** 2):
+				found.append(obj)
+		return found
+
+	def on_line(self, x1, y1, x2, y2):
+		#everything on the tiles of the line from (x1, y1) to (x2, y2), in the
+		#order a bolt would hit them. the line stops at the first wall
+		found = []
+		for (x, y) in line_points(x1, y1, x2, y2):
+			if map.blocked[x + y * map.width]:
+				break
+			found.extend(self.cells.get((x, y), ()))
+		return found
+
+	def is_blocked(self, x, y):
+		return (x, y) in self.blocking
+		
+	def fighter_at(self, x, y):
+		#the (first) living thing standing on the tile, if any
+		if (x, y) not in self.blocking:
+			return None
+		for obj in self.cells[(x, y)]:
+			if obj.fighter:
+				return obj
+		return None
+		
+last_oid = 0
+
+class Object(object):
 	#this is a generic object: the player, a monster, an item, the stairs...
 	#it's always represented by a character on screen.
+	__slots__ = ('oid', 'x', 'y', 'char', 'name', 'color', 'blocks', 'fighter', 'ai', 'item', 'caster')
+	
 	def __init__(self, x, y, char, name, color, blocks=False, caster=None, fighter=None, ai=None, item=None):
+		global last_oid
+		#a number that stays with the object for good, so saves can refer to it
+		last_oid += 1
+		self.oid = last_oid
+		
 		self.x = x
 		self.y = y
 		self.char = char
@@ -111,8 +524,7 @@ class Object:
 	def move(self, dx, dy):
 		#move by the given amount
 		if not is_blocked(self.x + dx, self.y + dy):
-			self.x += dx
-			self.y += dy
+			spatial_index.move(self, self.x + dx, self.y + dy)
 			
 	def move_towards(self, target_x, target_y):
 		#vector from this object to the target, and distance
@@ -136,17 +548,11 @@ class Object:
 		#return the distance to some coordinates
 		return math.sqrt((x - self.x) ** 2 + (y - self.y) ** 2)
 		
-	def send_to_back(self):
-		#make this object be drawn first
-		global objects
-		objects.remove(self)
-		objects.insert(0, self)
-	
 	def draw(self):
-		#set the color and then draw the character that represents this object at its position
-		if libtcod.map_is_in_fov(fov_map, self.x, self.y):
-			libtcod.console_set_default_foreground(con, self.color)
-			libtcod.console_put_char(con, self.x, self.y, self.char, libtcod.BKGND_NONE)
+		#set the color and then draw the character that represents this object at
+		#its position. render_all only asks the ones in the player's FOV
+		libtcod.console_set_default_foreground(con, self.color)
+		libtcod.console_put_char(con, self.x, self.y, self.char, libtcod.BKGND_NONE)
 		
 	def clear(self):
 		#erase the character that represents this object
@@ -154,13 +560,52 @@ class Object:
 	
 
 
-class Item:
+#++++++++++++++OBJECT POOL
+#objects and components that are gone for good (a floor written out to disk, a
+#monster's fighter and AI once it is a corpse) are kept as spares, and make()
+#sets a spare up again instead of allocating a new one
+
+POOL_LIMIT = 2000 #most spares kept of each class
+
+spares = {} #class -> instances nobody uses any more
+allocations = 0 #instances make() had to create from scratch, for bench.py
+
+def make(cls, *args, **kwargs):
+	#the same as cls(*args, **kwargs), but reusing a spare if there is one
+	global allocations
+	free = spares.get(cls)
+	if free:
+		instance = free.pop()
+		instance.__init__(*args, **kwargs)
+		return instance
+	allocations += 1
+	return cls(*args, **kwargs)
+	
+def keep_spare(instance):
+	if instance is None:
+		return
+	if isinstance(instance, ConfusedMonster):
+		keep_spare(instance.old_ai)
+		instance.old_ai = None
+	free = spares.setdefault(instance.__class__, [])
+	if len(free) < POOL_LIMIT:
+		free.append(instance)
+		
+def recycle(obj):
+	#an object and all its components become spares. nothing may use them after this
+	for component in (obj.fighter, obj.ai, obj.item, obj.caster):
+		keep_spare(component)
+	obj.fighter = obj.ai = obj.item = obj.caster = None
+	keep_spare(obj)
+	
+class Item(object):
+	__slots__ = ('use_function', 'multi_use', 'owner')
+	
 	def __init__(self, use_function=None, multi_use=False):
 		self.use_function = use_function
 		self.multi_use = multi_use
 		
 	def use(self):
-		global distortion
 		#just call the use_function
 		if self.use_function is None:
 			message('The ' + self.owner.name + ' cannot be used. Perhaps it has another purpose?')
@@ -168,13 +613,13 @@ class Item:
 			if self.use_function() != 'cancelled':
 				if self.multi_use is False:
 					inventory.remove(self.owner) #destroy after use unless it is canceled or is able to be used more than once
-					distortion = distortion + 1
+					distort()
 				
 	#an item that can be picked up and used.
 	def pick_up(self):
 		#add to the player's inventory and remove from the map
 		if len(inventory) >= 26:
-			sarcasm = libtcod.random_get_int(0, 0, 100)
+			sarcasm = libtcod.random_get_int(flavor_rng, 0, 100)
 			if sarcasm <= 20: 
 				message('You cannot carry any more items, puny man.', libtcod.dark_lime)
 			elif sarcasm <= 40 and sarcasm > 20: 
@@ -188,7 +633,8 @@ class Item:
 		else:
 			inventory.append(self.owner)
 			objects.remove(self.owner)
-			sarcasm = libtcod.random_get_int(0, 0, 100)
+			spatial_index.remove(self.owner)
+			sarcasm = libtcod.random_get_int(flavor_rng, 0, 100)
 			if sarcasm <= 20: 
 				message('You got yourself a shiny, new ' + self.owner.name + '. (Okay, maybe it was a little used.)', libtcod.lime)
 			elif sarcasm <= 40 and sarcasm > 20: 
@@ -206,27 +652,33 @@ class Item:
 		inventory.remove(self.owner)
 		self.owner.x = player.x
 		self.owner.y = player.y
+		spatial_index.add(self.owner)
 		message('You dropped a ' + self.owner.name + '.', libtcod.yellow)
 				
-class Caster:
+class Caster(object):
+	__slots__ = ('max_quantum', 'quantum', 'datamancy', 'owner')
+	
 	def __init__(self, quantum, alchemy):
 		self.max_quantum = quantum
 		self.quantum = quantum
 		self.datamancy = datamancy
 		
-class Fighter:
-	def __init__(self, hp, defense, power, energy, death_function=None):
+class Fighter(object):
+	__slots__ = ('max_hp', 'hp', 'defense', 'power', 'max_energy', 'energy', 'speed', 'death_function', 'owner')
+	
+	def __init__(self, hp, defense, power, energy, death_function=None, speed=NORMAL_SPEED):
 		self.max_hp = hp
 		self.hp = hp
 		self.defense = defense
 		self.power = power
 		self.max_energy = energy
 		self.energy = energy
+		self.speed = speed
 		self.death_function = death_function
 			
 	def attack(self, target):
 		#a simple formula for attack damage with some chance 
-		luck = libtcod.random_get_int(0, -3, 3)
+		luck = libtcod.random_get_int(combat_rng, -3, 3)
 			
 		basedmg = self.power - target.fighter.defense
 		damage = basedmg + luck
@@ -265,218 +717,640 @@ class Fighter:
 		
 
 
-class BasicMonster:
+class BasicMonster(object):
+	__slots__ = ('owner',)
+	
 	def take_turn(self):
 	#a basic monster takes its turn. If you can see it, it can see you
 		monster = self.owner
 		if libtcod.map_is_in_fov(fov_map, monster.x, monster.y):
-				
-			#move towards player if far away
-			if monster.distance_to(player) >= 2:
+			self.chase()
+			
+	def chase(self):
+		#the player is in sight
+		monster = self.owner
+		dx = player.x - monster.x
+		dy = player.y - monster.y
+		
+		#move towards player if far away, around the walls if need be
+		if dx * dx + dy * dy >= 4:
+			step = flow_field.step(monster.x, monster.y)
+			if step is None:
 				monster.move_towards(player.x, player.y)
-					
-			#close enough, attack! (if the player is still alive)
-			elif player.fighter.hp > 0:
-				monster.fighter.attack(player)
+			else:
+				monster.move(*step)
 				
-class ConfusedMonster:
+		#close enough, attack! (if the player is still alive)
+		elif player.fighter.hp > 0:
+			monster.fighter.attack(player)
+				
+class ConfusedMonster(object):
 	#AI for a confused monster.
-	def __init__(self, old_ai, num_turns=GLITCH_NUM_TURNS):
+	__slots__ = ('old_ai', 'num_turns', 'owner')
+	
+	def __init__(self, old_ai, num_turns=None):
 		self.old_ai = old_ai
+		if num_turns is None:
+			num_turns = GLITCH_NUM_TURNS
 		self.num_turns = num_turns
 		
 	def take_turn(self):
 		monster = self.owner
 		if self.num_turns > 0: #check if still confused
-			luck = libtcod.random_get_int(0, 0, 100)
+			luck = libtcod.random_get_int(ai_rng, 0, 100)
 			if luck < 80:
 				#move in a random direction
-				self.owner.move(libtcod.random_get_int(0, -1, 1), libtcod.random_get_int(0, -1, 1))
+				self.owner.move(libtcod.random_get_int(ai_rng, -1, 1), libtcod.random_get_int(ai_rng, -1, 1))
 				message('The ' + monster.name + ' bumbles around spitting out binary nonsense.', libtcod.light_grey)
 			else:
-				monster.fighter.take_damage(libtcod.random_get_int(0, 1, 4))
+				monster.fighter.take_damage(libtcod.random_get_int(combat_rng, 1, 4))
 				message('The ' + monster.name + ' damages itself while spitting out binary nonsense.', libtcod.light_red)
 			self.num_turns -= 1
 			
 		else: #restore the previous AI
-			self.owner.ai = self.old_ai
+			spatial_index.set_ai(self.owner, self.old_ai)
 			message('The ' + self.owner.name + ' has repaired its glitched drivers and is acting normally again', libtcod.light_orange)
 
+#how many steps out from the player the flow field reaches. chasing monsters are
+#in the player's FOV, so they're well inside it
+FLOW_RANGE = 3 * TORCH_RADIUS
+UNREACHED = 0xffff
+
+#the 8 directions a monster can step in
+DIRECTIONS = [(-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)]
+
+class FlowField(object):
+	#how many steps it is from each tile near the player to the player, going
+	#around walls, shared by every monster chasing them. it's only worked out
+	#again once the player moves or a wall changes, and then only when a monster
+	#asks for it
+	def __init__(self):
+		self.key = None
+		self.steps = None #steps to the player for every tile, packed like the Map
+		
+	def update(self):
+		key = (player.x, player.y, map, map.version)
+		if key == self.key:
+			return
+		self.key = key
+		
+		w = map.width
+		size = map.width * map.height
+		blocked = map.blocked
+		offsets = [(dx, dx + dy * w) for (dx, dy) in DIRECTIONS]
+		steps = array.array('H', [UNREACHED]) * size
+		
+		#breadth first out from the player, one ring of steps at a time
+		start = player.x + player.y * w
+		steps[start] = 0
+		frontier = [start]
+		for distance in range(1, FLOW_RANGE + 1):
+			next_frontier = []
+			for i in frontier:
+				x = i % w
+				for (dx, d) in offsets:
+					j = i + d
+					if 0 <= x + dx < w and 0 <= j < size and steps[j] == UNREACHED and not blocked[j]:
+						steps[j] = distance
+						next_frontier.append(j)
+			frontier = next_frontier
+		self.steps = steps
+		
+	def step(self, x, y):
+		#the (dx, dy) that gets a monster at (x, y) closer to the player, trying
+		#the straight line first. None if the player is out of reach or every
+		#way closer is blocked
+		self.update()
+		w = map.width
+		steps = self.steps
+		best = None
+		best_steps = steps[x + y * w]
+		if best_steps == UNREACHED:
+			return None
+		straight = ((player.x > x) - (player.x < x), (player.y > y) - (player.y < y))
+		for (dx, dy) in [straight] + DIRECTIONS:
+			(nx, ny) = (x + dx, y + dy)
+			if 0 <= nx < w and 0 <= ny < map.height and steps[nx + ny * w] < best_steps and not is_blocked(nx, ny):
+				best = (dx, dy)
+				best_steps = steps[nx + ny * w]
+		return best
+
+flow_field = FlowField()
+
+def action_time(obj):
+	#ticks of game time one action takes the object
+	if obj.fighter is None:
+		return ACTION_TIME
+	return ACTION_TIME * NORMAL_SPEED // obj.fighter.speed
+
+class AIScheduler(object):
+	#decides which monsters act, and when. a BasicMonster does nothing unless it
+	#can see the player, so only the ones standing in the player's FOV are woken
+	#up and the rest of the level sleeps. monsters with any other AI (glitched
+	#ones) act wherever they are, so they stay awake until they're back to normal.
+	#
+	#awake monsters wait in a heap by the game time of their next action, ties
+	#going to the one made first (the objects list order). each player action
+	#moves the clock on and the monsters act until they catch up with it, so a
+	#fast one acts more than once a turn and a slow one sits some turns out
+	def __init__(self):
+		self.restless = set()
+		self.clock = 0
+		self.queue = [] #(time, oid, object)
+		self.due = {} #object -> time of its next action, for everything in the queue
+		
+	def rebuild(self, index):
+		self.restless = set(obj for obj in index.thinkers if not isinstance(obj.ai, BasicMonster))
+		self.queue = []
+		self.due = {}
+		
+	def wake(self, obj):
+		self.restless.add(obj)
+		
+	def awake(self):
+		#the monsters that have a reason to act now. the ones in the FOV box are
+		#found through the spatial index and checked against the FOV all in one go
+		batch = []
+		for obj in spatial_index.in_box(player.x - TORCH_RADIUS, player.y - TORCH_RADIUS,
+				player.x + TORCH_RADIUS, player.y + TORCH_RADIUS):
+			if isinstance(obj.ai, BasicMonster) and libtcod.map_is_in_fov(fov_map, obj.x, obj.y):
+				batch.append(obj)
+		batch.extend(self.restless)
+		return batch
+		
+	def schedule(self, obj, time):
+		self.due[obj] = time
+		heapq.heappush(self.queue, (time, obj.oid, obj))
+		
+	def run(self):
+		#the player just used up an action, play the monsters up to the same time
+		self.clock += action_time(player)
+		for obj in self.awake():
+			if obj not in self.due:
+				self.schedule(obj, self.clock)
+				
+		queue = self.queue
+		while queue and queue[0][0] <= self.clock:
+			(time, oid, obj) = heapq.heappop(queue)
+			if isinstance(obj.ai, BasicMonster) and libtcod.map_is_in_fov(fov_map, obj.x, obj.y):
+				obj.ai.chase()
+			elif obj.ai and not isinstance(obj.ai, BasicMonster):
+				obj.ai.take_turn()
+			else:
+				#lost sight of the player, or died: back to sleep
+				del self.due[obj]
+				continue
+			self.schedule(obj, time + action_time(obj))
+			
+		#forget the ones that calmed down or died
+		for obj in [obj for obj in self.restless if obj.ai is None or isinstance(obj.ai, BasicMonster)]:
+			self.restless.discard(obj)
+
+ai_scheduler = AIScheduler()
+
 def is_blocked(x, y):
-	if map[x][y].blocked:
+	if map.blocked[x + y * map.width]:
 		return True
 	
-	for object in objects:
-		if object.blocks and object.x == x and object.y == y:
-			return True
-	
-	return False
+	return spatial_index.is_blocked(x, y)
 		
 def create_room(room):
 	global map
 	
-	for x in range(room.x1 + 1, room.x2):
-		for y in range(room.y1 + 1, room.y2):
-			map[x][y].blocked = False
-			map[x][y].block_sight = False
+	map.carve_rect(room.x1 + 1, room.y1 + 1, room.x2 - 1, room.y2 - 1)
+			
+def isqrt(n):
+	#the biggest whole number whose square is no more than n
+	root = int(math.sqrt(n))
+	while root * root > n:
+		root -= 1
+	while (root + 1) * (root + 1) <= n:
+		root += 1
+	return root
 			
 def create_circular_room(room):
 	global map
 	#center of circle
-	cx = (room.x1 + room.x2) / 2
-	cy = (room.y1 + room.y2) / 2
+	cx = (room.x1 + room.x2) // 2
+	cy = (room.y1 + room.y2) // 2
 
 	#radius of circle: make it fit nicely inside the room, by making the
 	#radius be half the width or height (whichever is smaller)
 	width = room.x2 - room.x1
 	height = room.y2 - room.y1
-	r = min(width, height) / 2
-
-	#go through the tiles in the circle and make them passable
-	for x in range(room.x1, room.x2 + 1):
-		for y in range(room.y1, room.y2 + 1):
-			if math.sqrt((x - cx) ** 2 + (y - cy) ** 2) <= r:
-				map[x][y].blocked = False
-				map[x][y].block_sight = False
+	r = min(width, height) // 2
+
+	#each row of the circle is one span of tiles, as wide as the circle is there
+	for y in range(max(room.y1, cy - r), min(room.y2, cy + r) + 1):
+		half = isqrt(r * r - (y - cy) ** 2)
+		map.carve_rect(max(room.x1, cx - half), y, min(room.x2, cx + half), y)
 			
 def create_h_tunnel(x1, x2, y):
 	global map
 	
-	for x in range(min(x1, x2), max(x1, x2) + 1):
-		map[x][y].blocked = False
-		map[x][y].block_sight = False
+	map.carve_rect(min(x1, x2), y, max(x1, x2), y)
 		
 def create_v_tunnel(y1, y2, x):
 	global map
 	
-	for y in range(min(y1, y2), max(y1, y2) +1):
-		map[x][y].blocked = False
-		map[x][y].block_sight = False
+	map.carve_column(x, min(y1, y2), max(y1, y2))
 		
+def room_is_free(taken, room):
+	#does the room (edges included) stay clear of every room marked in taken?
+	w = MAP_WIDTH
+	for y in range(room.y1, room.y2 + 1):
+		if taken.find(b'\x01', room.x1 + y * w, room.x2 + y * w + 1) != -1:
+			return False
+	return True
+	
+def mark_room(taken, room):
+	row = b'\x01' * (room.x2 - room.x1 + 1)
+	for y in range(room.y1, room.y2 + 1):
+		taken[room.x1 + y * MAP_WIDTH:room.x2 + y * MAP_WIDTH + 1] = row
 		
 		
-def make_map():
-	global map, player, objects, stairs
-	
-	objects = [player]
-	
-	#fill map with "blooked" tiles
-	map = [[ Tile(True)
-		for y in range(MAP_HEIGHT) ]
-			for x in range(MAP_WIDTH) ]
-			
+#++++++++++++++MAP GENERATORS
+#a generator builds the level into the global map with the dice it is given,
+#and yields the areas (Rects) that get monsters and items as it goes. the player
+#starts in the middle of the first area and the stairs go in the last one, so
+#every area has to have floor in its middle and be reachable from the others
+
+def rooms_generator(rng):
+	#rooms dropped at random, each joined to the one before by an L-shaped tunnel
 	rooms = []
-	num_rooms = 0
+	taken = bytearray(MAP_WIDTH * MAP_HEIGHT) #1 where a room (walls and all) already is
 	
 	for r in range(MAX_ROOMS):
-		w = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-		h = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+		w = libtcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+		h = libtcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
 		
-		x = libtcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-		y = libtcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
+		x = libtcod.random_get_int(rng, 0, MAP_WIDTH - w - 1)
+		y = libtcod.random_get_int(rng, 0, MAP_HEIGHT - h - 1)
 		
 		new_room = Rect(x, y, w, h)
 		
-		failed = False
-		for other_room in rooms:
-			if new_room.intersect(other_room):
-				failed = True
-				break
-				
-		if not failed:
-			luck = libtcod.random_get_int(0, 0, 100)
-			if luck > 70:
-				create_circular_room(new_room)
-			else:
-				create_room(new_room)
-				
-			
-			place_objects(new_room)
+		if room_is_free(taken, new_room):
+			mark_room(taken, new_room)
+			carve_room(rng, new_room)
+			yield new_room
 			
-			(new_x, new_y) = new_room.center()
-			
-			if num_rooms == 0:
-				player.x = new_x
-				player.y = new_y
-				
-			else:
-				(prev_x, prev_y) = rooms[num_rooms-1].center()
-				
-				if libtcod.random_get_int(0, 0, 1) == 1:
-					create_h_tunnel(prev_x, new_x, prev_y)
-					create_v_tunnel(prev_y, new_y, new_x)
-					
-				else:
-					create_v_tunnel(prev_y, new_y, prev_x)
-					create_h_tunnel(prev_x, new_x, new_y)
-					
+			if rooms:
+				join_rooms(rng, rooms[-1], new_room)
 			rooms.append(new_room)
-			num_rooms += 1
+			
+def carve_room(rng, room):
+	luck = libtcod.random_get_int(rng, 0, 100)
+	if luck > 70:
+		create_circular_room(room)
+	else:
+		create_room(room)
+		
+def join_rooms(rng, room, other):
+	#an L-shaped tunnel between the middles of two rooms
+	(prev_x, prev_y) = room.center()
+	(new_x, new_y) = other.center()
+	if libtcod.random_get_int(rng, 0, 1) == 1:
+		create_h_tunnel(prev_x, new_x, prev_y)
+		create_v_tunnel(prev_y, new_y, new_x)
+	else:
+		create_v_tunnel(prev_y, new_y, prev_x)
+		create_h_tunnel(prev_x, new_x, new_y)
+	
+#a BSP leaf is never split into parts smaller than this, so a room always fits
+BSP_LEAF_SIZE = ROOM_MAX_SIZE + 2
+
+def bsp_generator(rng):
+	#cut the map in two again and again, put a room in every piece and join the
+	#two halves of every cut, so the rooms tile the map without overlapping
+	rooms = []
+	bsp_split(rng, 0, 0, MAP_WIDTH - 1, MAP_HEIGHT - 1, rooms)
+	for room in rooms:
+		yield room
+		
+def bsp_split(rng, x1, y1, x2, y2, rooms):
+	can_split_x = x2 - x1 >= 2 * BSP_LEAF_SIZE
+	can_split_y = y2 - y1 >= 2 * BSP_LEAF_SIZE
+	if not (can_split_x or can_split_y):
+		#a leaf: a room somewhere inside it
+		w = libtcod.random_get_int(rng, ROOM_MIN_SIZE, min(ROOM_MAX_SIZE, x2 - x1))
+		h = libtcod.random_get_int(rng, ROOM_MIN_SIZE, min(ROOM_MAX_SIZE, y2 - y1))
+		room = Rect(libtcod.random_get_int(rng, x1, x2 - w), libtcod.random_get_int(rng, y1, y2 - h), w, h)
+		carve_room(rng, room)
+		rooms.append(room)
+		return
+		
+	#cut across the longer side, or either way if they're about the same
+	if can_split_x and can_split_y:
+		across_x = libtcod.random_get_int(rng, 0, x2 - x1 + y2 - y1) < x2 - x1
+	else:
+		across_x = can_split_x
+	first = len(rooms)
+	if across_x:
+		cut = libtcod.random_get_int(rng, x1 + BSP_LEAF_SIZE, x2 - BSP_LEAF_SIZE)
+		bsp_split(rng, x1, y1, cut, y2, rooms)
+		middle = len(rooms)
+		bsp_split(rng, cut, y1, x2, y2, rooms)
+	else:
+		cut = libtcod.random_get_int(rng, y1 + BSP_LEAF_SIZE, y2 - BSP_LEAF_SIZE)
+		bsp_split(rng, x1, y1, x2, cut, rooms)
+		middle = len(rooms)
+		bsp_split(rng, x1, cut, x2, y2, rooms)
+	join_rooms(rng, rooms[middle - 1], rooms[middle])
+	
+#cellular automaton caves: start with CAVE_FILL percent walls at random, then
+#CAVE_STEPS times turn every tile into wall if 5 or more of the 9 tiles around
+#it (itself included) are walls, and into floor if not
+CAVE_FILL = 45
+CAVE_STEPS = 4
+
+def cave_generator(rng):
+	w = MAP_WIDTH
+	h = MAP_HEIGHT
+	walls = bytearray(1 if roll < CAVE_FILL else 0 for roll in roll_many(rng, 0, 99, w * h))
+	for step in range(CAVE_STEPS):
+		walls = cave_step(walls, w, h)
+	
+	#only keep the biggest cave, so everything is reachable
+	seen = bytearray(walls)
+	biggest = []
+	for i in range(w * h):
+		if not seen[i]:
+			cave = flood_fill(walls, w, i, seen)
+			if len(cave) > len(biggest):
+				biggest = cave
+	walls = bytearray([1]) * (w * h)
+	for i in biggest:
+		walls[i] = 0
+	map.set_walls(walls)
+	
+	for area in floor_areas(rng, biggest):
+		yield area
+	
+def cave_step(walls, w, h):
+	#one round of the automaton over the packed grid. the walls around each tile
+	#are counted a row at a time: sums of 3 side by side first, then those sums
+	#for the rows above, on and below added up. off the map counts as wall
+	sums = []
+	for y in range(h):
+		row = bytearray([1]) + walls[y * w:(y + 1) * w] + bytearray([1])
+		sums.append([a + b + c for (a, b, c) in zip(row, row[1:], row[2:])])
+	solid = [3] * w
+	new_walls = bytearray()
+	for y in range(h):
+		above = sums[y - 1] if y > 0 else solid
+		below = sums[y + 1] if y < h - 1 else solid
+		new_walls += bytearray(1 if a + b + c >= 5 else 0 for (a, b, c) in zip(above, sums[y], below))
+	#keep a solid border
+	new_walls[:w] = bytearray([1]) * w
+	new_walls[-w:] = bytearray([1]) * w
+	new_walls[::w] = bytearray([1]) * h
+	new_walls[w - 1::w] = bytearray([1]) * h
+	return new_walls
+	
+#drunkard's walk: wander from the middle of the map digging, until this percent
+#of the map is floor (or it has taken WALK_MAX_STEPS steps)
+WALK_FLOOR = 35
+WALK_MAX_STEPS = 200000
+
+def walk_generator(rng):
+	w = MAP_WIDTH
+	h = MAP_HEIGHT
+	walls = bytearray([1]) * (w * h)
+	(x, y) = (w // 2, h // 2)
+	walls[x + y * w] = 0
+	dug = [x + y * w]
+	wanted = w * h * WALK_FLOOR // 100
+	steps = 0
+	while len(dug) < wanted and steps < WALK_MAX_STEPS:
+		for roll in roll_many(rng, 0, 3, 1000):
+			(dx, dy) = DIRECTIONS[(1, 3, 4, 6)[roll]]
+			#stay off the border
+			if 0 < x + dx < w - 1 and 0 < y + dy < h - 1:
+				x += dx
+				y += dy
+				if walls[x + y * w]:
+					walls[x + y * w] = 0
+					dug.append(x + y * w)
+		steps += 1000
+	map.set_walls(walls)
+	
+	for area in floor_areas(rng, dug):
+		yield area
+	
+def floor_areas(rng, floor):
+	#areas to put things in on a map without rooms: squares around floor tiles
+	#picked at random, starting with the first one in floor that has room for one
+	half = ROOM_MAX_SIZE // 2
+	w = MAP_WIDTH
+	inner = [i for i in floor if half <= i % w < MAP_WIDTH - half and half <= i // w < MAP_HEIGHT - half]
+	if not inner:
+		raise ValueError('the map is too small for any areas')
+	for roll in [0] + roll_many(rng, 0, len(inner) - 1, MAX_ROOMS - 1):
+		(x, y) = (inner[roll] % w, inner[roll] // w)
+		yield Rect(x - half, y - half, 2 * half, 2 * half)
+	
+def flood_fill(walls, w, start, seen=None):
+	#every tile that can be walked to from start (8 directions), as indices.
+	#tiles marked in seen are skipped, and the ones found get marked
+	if seen is None:
+		seen = bytearray(len(walls))
+	size = len(walls)
+	offsets = [(dx, dx + dy * w) for (dx, dy) in DIRECTIONS]
+	seen[start] = 1
+	found = [start]
+	for i in found:
+		x = i % w
+		for (dx, d) in offsets:
+			j = i + d
+			if 0 <= x + dx < w and 0 <= j < size and not seen[j] and not walls[j]:
+				seen[j] = 1
+				found.append(j)
+	return found
+	
+def connectivity(seen=None):
+	#the part of the level's floor the player can walk to, from 0 to 1. the
+	#tiles walked to get marked in seen, if given (see flood_fill)
+	floor = len(map.blocked) - map.blocked.count(b'\x01')
+	reached = flood_fill(map.blocked, map.width, player.x + player.y * map.width, seen)
+	return float(len(reached)) / max(floor, 1)
+	
+GENERATORS = {'rooms': rooms_generator, 'bsp': bsp_generator, 'cave': cave_generator, 'walk': walk_generator}
+
+generation_report = None #(generator name, seconds, areas) for the last level built
+
+def make_map():
+	global map, player, objects, stairs, downstairs, spatial_index, gen_rng, generation_report
+	
+	#the level's own dice, so it comes out the same every time it is built
+	gen_rng = libtcod.random_new_from_seed(level_seed(dungeon_level))
+	
+	objects = [player]
+	spatial_index = SpatialIndex()
+	
+	#fill map with "blooked" tiles
+	map = Map(MAP_WIDTH, MAP_HEIGHT)
+	
+	start = timeit.default_timer()
+	last_area = None
+	areas = 0
+	for area in GENERATORS[MAP_GENERATOR](gen_rng):
+		place_objects(area)
+		if last_area is None:
+			(player.x, player.y) = area.center()
+			spatial_index.add(player)
+		last_area = area
+		areas += 1
+	generation_report = (MAP_GENERATOR, timeit.default_timer() - start, areas)
 	
 	#create stairs at the center of the last room created
+	(new_x, new_y) = last_area.center()
 	stairs = Object(new_x, new_y, '<', 'stairs', libtcod.white)
 	objects.append(stairs)
-	stairs.send_to_back()
+	spatial_index.add(stairs)
+	
+	#and stairs back down where the player arrives
+	downstairs = None
+	if dungeon_level > 1:
+		downstairs = Object(player.x, player.y, '>', 'stairs down', libtcod.white)
+		objects.append(downstairs)
+		spatial_index.add(downstairs)
+	
+	libtcod.random_delete(gen_rng)
+	
+def level_seed(level):
+	#every level of a game has its own seed
+	return (game_seed * 7919 + level * 104729) & 0x7fffffff
+	
+def seed_rngs(seed):
+	#give every part of the game fresh dice, all following from one seed
+	global combat_rng, ai_rng, render_rng, flavor_rng
+	for rng in (combat_rng, ai_rng, render_rng, flavor_rng):
+		if rng != 0:
+			libtcod.random_delete(rng)
+	combat_rng = libtcod.random_new_from_seed((seed * 31 + 1) & 0x7fffffff)
+	ai_rng = libtcod.random_new_from_seed((seed * 31 + 2) & 0x7fffffff)
+	render_rng = libtcod.random_new_from_seed((seed * 31 + 3) & 0x7fffffff)
+	flavor_rng = libtcod.random_new_from_seed((seed * 31 + 4) & 0x7fffffff)
+	
+def roll_many(rng, low, high, count):
+	#count rolls in one go, for loops that need lots of them
+	get_int = libtcod.random_get_int
+	return [get_int(rng, low, high) for i in range(count)]
+			
+#++++++++++++++SPAWN TABLES
+#what can turn up in a room lives in SPAWN_FILE: a list of monsters and a list of
+#items, each with its looks, its components and a weight. the weight is either a
+#number or {"level": weight, ...}, meaning that weight from that dungeon level
+#down. an entry is picked with chance weight / (sum of the weights)
+
+SPAWN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spawns.json')
+
+spawn_prototypes = None #'monsters'/'items' -> list of Prototypes, read when first needed
+spawn_tables = {} #(kind, dungeon level) -> (running totals of the weights, Prototypes)
+
+class Prototype:
+	#one entry of the spawn file with the names in it already looked up, so
+	#making a monster or item from it is only the constructor calls
+	def __init__(self, entry, blocks):
+		self.name = str(entry['name'])
+		self.char = str(entry['char'])
+		self.color = getattr(libtcod, entry['color'])
+		self.blocks = blocks
+		self.weight = entry['weight']
+		
+		self.fighter = None
+		if 'fighter' in entry:
+			self.fighter = dict((str(key), value) for (key, value) in entry['fighter'].items())
+			self.fighter['death_function'] = by_name(DEATH_FUNCTIONS)[self.fighter['death_function']]
+		self.ai = None
+		if 'ai' in entry:
+			self.ai = by_name(AI_KINDS)[entry['ai']]
+		self.use_function = None
+		if 'use_function' in entry:
+			self.use_function = by_name(USE_FUNCTIONS)[entry['use_function']]
 			
+	def weight_at(self, level):
+		if not isinstance(self.weight, dict):
+			return self.weight
+		weight = 0
+		for (from_level, level_weight) in sorted((int(key), value) for (key, value) in self.weight.items()):
+			if from_level <= level:
+				weight = level_weight
+		return weight
+		
+	def spawn(self, x, y):
+		fighter = None
+		if self.fighter is not None:
+			fighter = make(Fighter, **self.fighter)
+		ai = None
+		if self.ai is not None:
+			ai = make(self.ai)
+		item = None
+		if self.use_function is not None:
+			item = make(Item, use_function=self.use_function)
+		return make(Object, x, y, self.char, self.name, self.color, blocks=self.blocks, fighter=fighter, ai=ai, item=item)
+		
+def by_name(things):
+	#functions or classes from one of the save code lists, by name
+	return dict((thing.__name__, thing) for thing in things if thing is not None)
+	
+def spawn_table(kind, level):
+	#the weights for a level added up as they go, for bisect to search
+	global spawn_prototypes
+	if spawn_prototypes is None:
+		with open(SPAWN_FILE) as file:
+			entries = json.load(file)
+		spawn_prototypes = {
+			'monsters': [Prototype(entry, True) for entry in entries['monsters']],
+			'items': [Prototype(entry, False) for entry in entries['items']],
+			}
+	key = (kind, level)
+	if key not in spawn_tables:
+		prototypes = [prototype for prototype in spawn_prototypes[kind] if prototype.weight_at(level) > 0]
+		totals = []
+		total = 0
+		for prototype in prototypes:
+			total += prototype.weight_at(level)
+			totals.append(total)
+		spawn_tables[key] = (totals, prototypes)
+	return spawn_tables[key]
+	
+def pick(rng, table):
+	#a Prototype from a spawn table, in one roll and a binary search
+	(totals, prototypes) = table
+	return prototypes[bisect.bisect_right(totals, libtcod.random_get_int(rng, 0, totals[-1] - 1))]
+	
 def place_objects(room):
-	num_monsters = libtcod.random_get_int(0, 0, MAX_ROOM_MONSTERS)
+	monsters = spawn_table('monsters', dungeon_level)
+	items = spawn_table('items', dungeon_level)
+	
+	num_monsters = libtcod.random_get_int(gen_rng, 0, MAX_ROOM_MONSTERS)
 	
+	spawned = []
 	for i in range(num_monsters):
-		x = libtcod.random_get_int(0, room.x1+1, room.x2-1)
-		y = libtcod.random_get_int(0, room.y1+1, room.y2-1)
-		
-		if not is_blocked(x, y):
-			choice = libtcod.random_get_int(0, 0, 100)
-			if choice < 20:
-				#malfunctioning service bot
-				fighter_component = Fighter(hp=15, defense=1, power =3, energy=10, death_function=monster_death)
-				ai_component = BasicMonster()
-				monster = Object(x, y, 'r', 'malfunctioning service robot', libtcod.lightest_grey, blocks=True, ai=ai_component, fighter=fighter_component)
-			elif choice < 40 and choice >= 20:
-				#basic security robot
-				fighter_component = Fighter(hp=13, defense=1, power =4, energy=10, death_function=monster_death)
-				ai_component = BasicMonster()
-				monster = Object(x, y, 's', 'security robot', libtcod.darkest_green, blocks=True, ai=ai_component, fighter=fighter_component)
-			elif choice < 60 and choice >= 40:
-				#brain in a jar
-				fighter_component = Fighter(hp=8, defense=0, power =1, energy=10, death_function=monster_death)
-				ai_component = BasicMonster()
-				monster = Object(x, y, 'b', 'brain in a jar', libtcod.light_pink, blocks=True, ai=ai_component, fighter=fighter_component)
-			else:
-				#scrap metal
-				fighter_component = Fighter(hp=10, defense=0, power =3, energy=10, death_function=monster_death)
-				ai_component = BasicMonster()
-				monster = Object(x, y, 'm', 'sentient scrap metal', libtcod.light_grey, blocks=True, ai=ai_component, fighter=fighter_component)
-			
-			objects.append(monster)
+		x = libtcod.random_get_int(gen_rng, room.x1+1, room.x2-1)
+		y = libtcod.random_get_int(gen_rng, room.y1+1, room.y2-1)
+		
+		if not is_blocked(x, y) and monsters[0]:
+			monster = pick(gen_rng, monsters).spawn(x, y)
+			spatial_index.add(monster)
+			spawned.append(monster)
+	objects.extend(spawned)
 			
-	num_items = libtcod.random_get_int(0, 0, MAX_ROOM_ITEMS)
+	num_items = libtcod.random_get_int(gen_rng, 0, MAX_ROOM_ITEMS)
 	
+	spawned = []
 	for i in range(num_items):
 		#choose random spot for this item
-		x = libtcod.random_get_int(0, room.x1+1, room.x2-1)
-		y = libtcod.random_get_int(0, room.y1+1, room.y2-1)
+		x = libtcod.random_get_int(gen_rng, room.x1+1, room.x2-1)
+		y = libtcod.random_get_int(gen_rng, room.y1+1, room.y2-1)
 		
 		#only place it if the tile is not blocked
-		if not is_blocked(x, y):
-			dice = libtcod.random_get_int(0, 0, 1000)
-			if dice < 700:
-				#create an oil can
-				item_component = Item(use_function=cast_heal)
-				item = Object(x, y, '!', 'oil can', libtcod.black, item=item_component)
-			elif dice < 700+100:
-				item_component = Item(use_function=cast_glitch)
-				item = Object (x, y, '#', 'glitch script', libtcod.light_green, item=item_component)
-			elif dice < 700+100+100:
-				item_component = Item(use_function=cast_gravitywell)
-				item = Object (x, y, ',', 'unstable anti-matter', libtcod.black, item=item_component)
-			else:
-				#create a database corrupter
-				item_component = Item(use_function=cast_corrupt)
-				item = Object(x, y, '#', 'database corrupt script', libtcod.light_green, item=item_component)
-			
-			objects.append(item)
-			item.send_to_back() #items appear below other objects
+		if not is_blocked(x, y) and items[0]:
+			item = pick(gen_rng, items).spawn(x, y)
+			spatial_index.add(item)
+			spawned.append(item)
+	objects.extend(spawned)
 
 
 def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
@@ -509,419 +1383,161 @@ def message(new_msg, color = libtcod.white):
 		game_msgs.append( (line, color) )
 
 	
+def sample_tiles(rng, count, chance):
+	#roll a dice for each of count tiles that hits with the given chance, and
+	#return the hit positions. instead of one roll per tile this jumps straight
+	#from hit to hit, so it only draws about as many numbers as there are hits
+	hits = []
+	if chance <= 0:
+		return hits
+	if chance >= 1:
+		return list(range(count))
+	log_miss = math.log(1.0 - chance)
+	i = -1
+	while True:
+		roll = max(libtcod.random_get_float(rng, 0.0, 1.0), 1e-12)
+		i += 1 + int(math.log(roll) / log_miss)
+		if i >= count:
+			return hits
+		hits.append(i)
+	
+def pick_flickers(hits, explored, block_sight, in_view, spaced):
+	#which of the hit tiles (in map order) flicker, as (position in hits, tile
+	#code). a tile flickers if it's been seen, but when spaced (the normal
+	#palette) not if the tile before it of the same kind flickered, hit or not.
+	#last[code] is the last tile of that kind that flickered, as long as it
+	#could still be the one right before the next; the tiles after it only get
+	#looked at once, so a frame never costs more than one pass over the map
+	last = [None] * 5
+	found = []
+	for n in range(len(hits)):
+		i = hits[n]
+		code = explored[i] and 1 + block_sight[i] + 2 * in_view[i]
+		if not code:
+			continue
+		if spaced:
+			j = last[code]
+			if j is not None:
+				#any tile of the same kind in between didn't flicker, which lets
+				#this one
+				j += 1
+				while j < i and (explored[j] and 1 + block_sight[j] + 2 * in_view[j]) != code:
+					j += 1
+				if j == i:
+					last[code] = None
+					continue
+			last[code] = i
+		found.append((n, code))
+	return found
+	
+def render_map():
+	#work out the background of every tile that can look different from the last
+	#frame with the palette tables, then send the colors to the console
+	global full_redraw, last_fov_box, last_strobe, drawn, in_view, flickering
+	
+	w = map.width
+	size = map.width * map.height
+	block_sight = map.block_sight
+	explored = map.explored
+	palette = PALETTES[strobe]
+	
+	if full_redraw:
+		#new level or loaded game: the console was cleared, forget the old frame
+		drawn = [libtcod.black] * size
+		in_view = bytearray(size)
+		flickering = []
+		last_fov_box = None
+	
+	#only the tiles around the player can come into or go out of view
+	fx1 = max(0, player.x - TORCH_RADIUS)
+	fy1 = max(0, player.y - TORCH_RADIUS)
+	fx2 = min(map.width - 1, player.x + TORCH_RADIUS)
+	fy2 = min(map.height - 1, player.y + TORCH_RADIUS)
+	
+	if last_fov_box is not None:
+		(ox1, oy1, ox2, oy2) = last_fov_box
+		for y in range(oy1, oy2 + 1):
+			in_view[ox1 + y * w:ox2 + 1 + y * w] = bytearray(ox2 - ox1 + 1)
+	for y in range(fy1, fy2 + 1):
+		i = fx1 + y * w
+		for x in range(fx1, fx2 + 1):
+			if libtcod.map_is_in_fov(fov_map, x, y):
+				in_view[i] = 1
+				explored[i] = 1
+			i += 1
+	
+	repaint = full_redraw or strobe != last_strobe
+	full_redraw = False
+	if repaint:
+		#every explored tile changes color, do the whole map in one go
+		colors = [palette[explored[i] and 1 + block_sight[i] + 2 * in_view[i]][0] for i in range(size)]
+		changed = colors
+	else:
+		#the area that was in view last frame plus the area in view now, and
+		#the tiles that were distorted last frame
+		(x1, y1, x2, y2) = (fx1, fy1, fx2, fy2)
+		if last_fov_box is not None:
+			(x1, y1, x2, y2) = (min(x1, ox1), min(y1, oy1), max(x2, ox2), max(y2, oy2))
+		changed = {}
+		for y in range(y1, y2 + 1):
+			for i in range(x1 + y * w, x2 + 1 + y * w):
+				changed[i] = palette[explored[i] and 1 + block_sight[i] + 2 * in_view[i]][0]
+		for i in flickering:
+			changed[i] = palette[explored[i] and 1 + block_sight[i] + 2 * in_view[i]][0]
+	
+	#all of the frame's distortion dice at once: which tiles get hit, and then
+	#one luck roll per hit
+	hits = sample_tiles(render_rng, size, float(distortion) / max_dist)
+	luck = roll_many(render_rng, 0, 9, len(hits))
+	
+	flickering = []
+	for (n, code) in pick_flickers(hits, explored, block_sight, in_view, strobe > 4):
+		i = hits[n]
+		changed[i] = palette[code][1][luck[n]]
+		flickering.append(i)
+	
+	if repaint:
+		libtcod.console_fill_background(con, [c.r for c in colors], [c.g for c in colors], [c.b for c in colors])
+		drawn = colors
+	else:
+		#only talk to the console about the tiles whose color really changed
+		for (i, color) in changed.items():
+			if color is not drawn[i]:
+				libtcod.console_set_char_background(con, i % w, i // w, color, libtcod.BKGND_SET)
+				drawn[i] = color
+	
+	last_fov_box = (fx1, fy1, fx2, fy2)
+	last_strobe = strobe
+	
+on_screen = [] #the objects drawn in the last frame
+
 def render_all():
 	global fov_map, color_dark_wall, color_light_wall
 	global color_dark_ground, color_light_ground
 	global fov_recompute
-	global strobe, first_time, distortion, max_dist
-	global DG, DW, LG, LW
-	
-	if distortion > max_dist:
-		distortion = max_dist
+	global strobe, first_time, on_screen
 	
 	if fov_recompute:
 		if first_time:
 			strobe = 10
 			first_time = False
-
-			distortion = 0
 		else:
-			dice = libtcod.random_get_int(0, 1, max_dist)
+			dice = libtcod.random_get_int(render_rng, 1, max_dist)
 			if dice <= distortion:
-				strobe = libtcod.random_get_int(0, 1, 10)
+				strobe = libtcod.random_get_int(render_rng, 1, 10)
 			else:
 				strobe = 10
 	
 		fov_recompute = False
-		libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
-		
-		for y in range(MAP_HEIGHT):
-			for x in range(MAP_WIDTH):
-				visible = libtcod.map_is_in_fov(fov_map, x, y)
-				wall = map[x][y].block_sight
-				if not visible:
-					if map[x][y].explored:
-						if wall:
-						
-							if strobe == 1:
-								dice = libtcod.random_get_int(0, 1, max_dist)
-								if dice <= distortion:
-									luck = libtcod.random_get_int(0, 1, 5)
-									if luck == 1:
-										libtcod.console_set_char_background(con, x, y, libtcod.yellow, libtcod.BKGND_SET)
-									elif luck == 2:
-										libtcod.console_set_char_background(con, x, y, libtcod.pink, libtcod.BKGND_SET)
-									elif luck == 3:
-										libtcod.console_set_char_background(con, x, y, libtcod.flame, libtcod.BKGND_SET)
-									elif luck == 4:
-										libtcod.console_set_char_background(con, x, y, libtcod.grey, libtcod.BKGND_SET)
-									else:
-										libtcod.console_set_char_background(con, x, y, libtcod.blue, libtcod.BKGND_SET)
-								else:
-									libtcod.console_set_char_background(con, x, y, libtcod.darker_green, libtcod.BKGND_SET)
-									
-							elif strobe == 2:
-								dice = libtcod.random_get_int(0, 1, max_dist)
-								if dice <= distortion:
-									luck = libtcod.random_get_int(0, 1, 5)
-									if luck == 1:
-										libtcod.console_set_char_background(con, x, y, libtcod.yellow, libtcod.BKGND_SET)
-									elif luck == 2:
-										libtcod.console_set_char_background(con, x, y, libtcod.pink, libtcod.BKGND_SET)
-									elif luck == 3:
-										libtcod.console_set_char_background(con, x, y, libtcod.flame, libtcod.BKGND_SET)
-									elif luck == 4:
-										libtcod.console_set_char_background(con, x, y, libtcod.grey, libtcod.BKGND_SET)
-									else:
-										libtcod.console_set_char_background(con, x, y, libtcod.green, libtcod.BKGND_SET)
-								else:
-									libtcod.console_set_char_background(con, x, y, libtcod.darker_blue, libtcod.BKGND_SET)
-									
-							elif strobe == 3:
-								dice = libtcod.random_get_int(0, 1, max_dist)
-								if dice <= distortion:
-									luck = libtcod.random_get_int(0, 1, 5)
-									if luck == 1:
-										libtcod.console_set_char_background(con, x, y, libtcod.yellow, libtcod.BKGND_SET)
-									elif luck == 2:
-										libtcod.console_set_char_background(con, x, y, libtcod.pink, libtcod.BKGND_SET)
-									elif luck == 3:
-										libtcod.console_set_char_background(con, x, y, libtcod.blue, libtcod.BKGND_SET)
-									elif luck == 4:
-										libtcod.console_set_char_background(con, x, y, libtcod.grey, libtcod.BKGND_SET)
-									else:
-										libtcod.console_set_char_background(con, x, y, libtcod.green, libtcod.BKGND_SET)
-								else:
-									libtcod.console_set_char_background(con, x, y, libtcod.darker_flame, libtcod.BKGND_SET)
-								
-							elif strobe == 4:
-								dice = libtcod.random_get_int(0, 1, max_dist)
-								if dice <= distortion:
-									luck = libtcod.random_get_int(0, 1, 5)
-									if luck == 1:
-										libtcod.console_set_char_background(con, x, y, libtcod.yellow, libtcod.BKGND_SET)
-									elif luck == 2:
-										libtcod.console_set_char_background(con, x, y, libtcod.blue, libtcod.BKGND_SET)
-									elif luck == 3:
-										libtcod.console_set_char_background(con, x, y, libtcod.flame, libtcod.BKGND_SET)
-									elif luck == 4:
-										libtcod.console_set_char_background(con, x, y, libtcod.grey, libtcod.BKGND_SET)
-									else:
-										libtcod.console_set_char_background(con, x, y, libtcod.green, libtcod.BKGND_SET)
-								else:
-									libtcod.console_set_char_background(con, x, y, libtcod.darker_pink, libtcod.BKGND_SET)
-								
-							else:
-								dice = libtcod.random_get_int(0, 1, max_dist)
-								if dice <= distortion and DW is False:
-									luck = libtcod.random_get_int(0, 1, 5)
-									if luck == 1:
-										libtcod.console_set_char_background(con, x, y, libtcod.yellow, libtcod.BKGND_SET)
-									elif luck == 2:
-										libtcod.console_set_char_background(con, x, y, libtcod.pink, libtcod.BKGND_SET)
-									elif luck == 3:
-										libtcod.console_set_char_background(con, x, y, libtcod.flame, libtcod.BKGND_SET)
-									elif luck == 4:
-										libtcod.console_set_char_background(con, x, y, libtcod.blue, libtcod.BKGND_SET)
-									else:
-										libtcod.console_set_char_background(con, x, y, libtcod.green, libtcod.BKGND_SET)
-									DW = True
-								else:
-									libtcod.console_set_char_background(con, x, y, color_dark_wall, libtcod.BKGND_SET)
-									DW = False
-						else:
-							if strobe == 1:
-								dice = libtcod.random_get_int(0, 1, max_dist)
-								if dice <= distortion:
-									luck = libtcod.random_get_int(0, 1, 5)
-									if luck == 1:
-										libtcod.console_set_char_background(con, x, y, libtcod.yellow, libtcod.BKGND_SET)
-									elif luck == 2:
-										libtcod.console_set_char_background(con, x, y, libtcod.pink, libtcod.BKGND_SET)
-									elif luck == 3:
-										libtcod.console_set_char_background(con, x, y, libtcod.flame, libtcod.BKGND_SET)
-									elif luck == 4:
-										libtcod.console_set_char_background(con, x, y, libtcod.grey, libtcod.BKGND_SET)
-									else:
-										libtcod.console_set_char_background(con, x, y, libtcod.blue, libtcod.BKGND_SET)
-								else:
-									libtcod.console_set_char_background(con, x, y, libtcod.dark_green, libtcod.BKGND_SET)
-								
-							elif strobe == 2:
-								dice = libtcod.random_get_int(0, 1, max_dist)
-								if dice <= distortion:
-									luck = libtcod.random_get_int(0, 1, 5)
-									if luck == 1:
-										libtcod.console_set_char_background(con, x, y, libtcod.yellow, libtcod.BKGND_SET)
-									elif luck == 2:
-										libtcod.console_set_char_background(con, x, y, libtcod.pink, libtcod.BKGND_SET)
-									elif luck == 3:
-										libtcod.console_set_char_background(con, x, y, libtcod.flame, libtcod.BKGND_SET)
-									elif luck == 4:
-										libtcod.console_set_char_background(con, x, y, libtcod.grey, libtcod.BKGND_SET)
-									else:
-										libtcod.console_set_char_background(con, x, y, libtcod.green, libtcod.BKGND_SET)
-								else:
-									libtcod.console_set_char_background(con, x, y, libtcod.dark_blue, libtcod.BKGND_SET)
-								
-							elif strobe == 3:
-								dice = libtcod.random_get_int(0, 1, max_dist)
-								if dice <= distortion:
-									luck = libtcod.random_get_int(0, 1, 5)
-									if luck == 1:
-										libtcod.console_set_char_background(con, x, y, libtcod.yellow, libtcod.BKGND_SET)
-									elif luck == 2:
-										libtcod.console_set_char_background(con, x, y, libtcod.pink, libtcod.BKGND_SET)
-									elif luck == 3:
-										libtcod.console_set_char_background(con, x, y, libtcod.blue, libtcod.BKGND_SET)
-									elif luck == 4:
-										libtcod.console_set_char_background(con, x, y, libtcod.grey, libtcod.BKGND_SET)
-									else:
-										libtcod.console_set_char_background(con, x, y, libtcod.green, libtcod.BKGND_SET)
-								else:
-									libtcod.console_set_char_background(con, x, y, libtcod.dark_flame, libtcod.BKGND_SET)
-								
-							elif strobe == 4:
-								dice = libtcod.random_get_int(0, 1, max_dist)
-								if dice <= distortion:
-									luck = libtcod.random_get_int(0, 1, 5)
-									if luck == 1:
-										libtcod.console_set_char_background(con, x, y, libtcod.yellow, libtcod.BKGND_SET)
-									elif luck == 2:
-										libtcod.console_set_char_background(con, x, y, libtcod.blue, libtcod.BKGND_SET)
-									elif luck == 3:
-										libtcod.console_set_char_background(con, x, y, libtcod.flame, libtcod.BKGND_SET)
-									elif luck == 4:
-										libtcod.console_set_char_background(con, x, y, libtcod.grey, libtcod.BKGND_SET)
-									else:
-										libtcod.console_set_char_background(con, x, y, libtcod.green, libtcod.BKGND_SET)
-								else:
-									libtcod.console_set_char_background(con, x, y, libtcod.dark_pink, libtcod.BKGND_SET)
-								
-							else:
-								dice = libtcod.random_get_int(0, 1, max_dist)
-								if dice <= distortion and DG is False:
-									luck = libtcod.random_get_int(0, 1, 5)
-									if luck == 1:
-										libtcod.console_set_char_background(con, x, y, libtcod.yellow, libtcod.BKGND_SET)
-									elif luck == 2:
-										libtcod.console_set_char_background(con, x, y, libtcod.pink, libtcod.BKGND_SET)
-									elif luck == 3:
-										libtcod.console_set_char_background(con, x, y, libtcod.flame, libtcod.BKGND_SET)
-									elif luck == 4:
-										libtcod.console_set_char_background(con, x, y, libtcod.grey, libtcod.BKGND_SET)
-									else:
-										libtcod.console_set_char_background(con, x, y, libtcod.green, libtcod.BKGND_SET)
-									DG = True
-								else:
-									libtcod.console_set_char_background(con, x, y, color_dark_ground, libtcod.BKGND_SET)
-									DG = False
-								
-				else:
-					if wall:
-						if strobe == 1:
-							dice = libtcod.random_get_int(0, 1, max_dist)
-							if dice <= distortion:
-								luck = libtcod.random_get_int(0, 1, 10)
-								if luck == 1:
-									libtcod.console_set_char_background(con, x, y, libtcod.yellow, libtcod.BKGND_SET)
-								elif luck == 2:
-									libtcod.console_set_char_background(con, x, y, libtcod.pink, libtcod.BKGND_SET)
-								elif luck == 3:
-									libtcod.console_set_char_background(con, x, y, libtcod.flame, libtcod.BKGND_SET)
-								elif luck == 4:
-									libtcod.console_set_char_background(con, x, y, libtcod.grey, libtcod.BKGND_SET)
-								elif luck == 5:
-									libtcod.console_set_char_background(con, x, y, libtcod.blue, libtcod.BKGND_SET)
-								else:
-									libtcod.console_set_char_background(con, x, y, libtcod.green, libtcod.BKGND_SET)
-							else:
-								libtcod.console_set_char_background(con, x, y, libtcod.green, libtcod.BKGND_SET)
-							
-						elif strobe == 2:
-							dice = libtcod.random_get_int(0, 1, max_dist)
-							if dice <= distortion:
-								luck = libtcod.random_get_int(0, 1, 10)
-								if luck == 1:
-									libtcod.console_set_char_background(con, x, y, libtcod.yellow, libtcod.BKGND_SET)
-								elif luck == 2:
-									libtcod.console_set_char_background(con, x, y, libtcod.pink, libtcod.BKGND_SET)
-								elif luck == 3:
-									libtcod.console_set_char_background(con, x, y, libtcod.flame, libtcod.BKGND_SET)
-								elif luck == 4:
-									libtcod.console_set_char_background(con, x, y, libtcod.grey, libtcod.BKGND_SET)
-								elif luck == 5:
-									libtcod.console_set_char_background(con, x, y, libtcod.green, libtcod.BKGND_SET)
-								else:
-									libtcod.console_set_char_background(con, x, y, libtcod.blue, libtcod.BKGND_SET)
-							else:
-								libtcod.console_set_char_background(con, x, y, libtcod.blue, libtcod.BKGND_SET)
-							
-						elif strobe == 3:
-							dice = libtcod.random_get_int(0, 1, max_dist)
-							if dice <= distortion:
-								luck = libtcod.random_get_int(0, 1, 10)
-								if luck == 1:
-									libtcod.console_set_char_background(con, x, y, libtcod.yellow, libtcod.BKGND_SET)
-								elif luck == 2:
-									libtcod.console_set_char_background(con, x, y, libtcod.pink, libtcod.BKGND_SET)
-								elif luck == 3:
-									libtcod.console_set_char_background(con, x, y, libtcod.green, libtcod.BKGND_SET)
-								elif luck == 4:
-									libtcod.console_set_char_background(con, x, y, libtcod.grey, libtcod.BKGND_SET)
-								elif luck == 5:
-									libtcod.console_set_char_background(con, x, y, libtcod.blue, libtcod.BKGND_SET)
-								else:
-									libtcod.console_set_char_background(con, x, y, libtcod.flame, libtcod.BKGND_SET)
-							else:
-								libtcod.console_set_char_background(con, x, y, libtcod.flame, libtcod.BKGND_SET)
-							
-						elif strobe == 4:
-							dice = libtcod.random_get_int(0, 1, max_dist)
-							if dice <= distortion:
-								luck = libtcod.random_get_int(0, 1, 10)
-								if luck == 1:
-									libtcod.console_set_char_background(con, x, y, libtcod.yellow, libtcod.BKGND_SET)
-								elif luck == 2:
-									libtcod.console_set_char_background(con, x, y, libtcod.green, libtcod.BKGND_SET)
-								elif luck == 3:
-									libtcod.console_set_char_background(con, x, y, libtcod.flame, libtcod.BKGND_SET)
-								elif luck == 4:
-									libtcod.console_set_char_background(con, x, y, libtcod.grey, libtcod.BKGND_SET)
-								elif luck == 5:
-									libtcod.console_set_char_background(con, x, y, libtcod.blue, libtcod.BKGND_SET)
-								else:
-									libtcod.console_set_char_background(con, x, y, libtcod.pink, libtcod.BKGND_SET)
-							else:
-								libtcod.console_set_char_background(con, x, y, libtcod.pink, libtcod.BKGND_SET)
-							
-						else:
-							dice = libtcod.random_get_int(0, 1, max_dist)
-							if dice <= distortion and LW is False:
-								luck = libtcod.random_get_int(0, 1, 10)
-								if luck == 1:
-									libtcod.console_set_char_background(con, x, y, libtcod.yellow, libtcod.BKGND_SET)
-								elif luck == 2:
-									libtcod.console_set_char_background(con, x, y, libtcod.pink, libtcod.BKGND_SET)
-								elif luck == 3:
-									libtcod.console_set_char_background(con, x, y, libtcod.flame, libtcod.BKGND_SET)
-								elif luck == 4:
-									libtcod.console_set_char_background(con, x, y, libtcod.green, libtcod.BKGND_SET)
-								elif luck == 5:
-									libtcod.console_set_char_background(con, x, y, libtcod.blue, libtcod.BKGND_SET)
-								else:
-									libtcod.console_set_char_background(con, x, y, color_light_wall, libtcod.BKGND_SET)
-								LW = True
-							else:
-								libtcod.console_set_char_background(con, x, y, color_light_wall, libtcod.BKGND_SET)
-								LW = False
-							
-					else:
-						if strobe == 1:
-							dice = libtcod.random_get_int(0, 1, max_dist)
-							if dice <= distortion:
-								luck = libtcod.random_get_int(0, 1, 10)
-								if luck == 1:
-									libtcod.console_set_char_background(con, x, y, libtcod.yellow, libtcod.BKGND_SET)
-								elif luck == 2:
-									libtcod.console_set_char_background(con, x, y, libtcod.pink, libtcod.BKGND_SET)
-								elif luck == 3:
-									libtcod.console_set_char_background(con, x, y, libtcod.flame, libtcod.BKGND_SET)
-								elif luck == 4:
-									libtcod.console_set_char_background(con, x, y, libtcod.grey, libtcod.BKGND_SET)
-								elif luck == 5:
-									libtcod.console_set_char_background(con, x, y, libtcod.blue, libtcod.BKGND_SET)
-								else:
-									libtcod.console_set_char_background(con, x, y, libtcod.light_green, libtcod.BKGND_SET)
-							else:
-								libtcod.console_set_char_background(con, x, y, libtcod.light_green, libtcod.BKGND_SET)
-							
-						elif strobe == 2:
-							dice = libtcod.random_get_int(0, 1, max_dist)
-							if dice <= distortion:
-								luck = libtcod.random_get_int(0, 1, 10)
-								if luck == 1:
-									libtcod.console_set_char_background(con, x, y, libtcod.yellow, libtcod.BKGND_SET)
-								elif luck == 2:
-									libtcod.console_set_char_background(con, x, y, libtcod.pink, libtcod.BKGND_SET)
-								elif luck == 3:
-									libtcod.console_set_char_background(con, x, y, libtcod.flame, libtcod.BKGND_SET)
-								elif luck == 4:
-									libtcod.console_set_char_background(con, x, y, libtcod.grey, libtcod.BKGND_SET)
-								elif luck == 5:
-									libtcod.console_set_char_background(con, x, y, libtcod.green, libtcod.BKGND_SET)
-								else:
-									libtcod.console_set_char_background(con, x, y, libtcod.light_blue, libtcod.BKGND_SET)
-							else:
-								libtcod.console_set_char_background(con, x, y, libtcod.light_blue, libtcod.BKGND_SET)
-							
-						elif strobe == 3:
-							dice = libtcod.random_get_int(0, 1, max_dist)
-							if dice <= distortion:
-								luck = libtcod.random_get_int(0, 1, 10)
-								if luck == 1:
-									libtcod.console_set_char_background(con, x, y, libtcod.yellow, libtcod.BKGND_SET)
-								elif luck == 2:
-									libtcod.console_set_char_background(con, x, y, libtcod.pink, libtcod.BKGND_SET)
-								elif luck == 3:
-									libtcod.console_set_char_background(con, x, y, libtcod.green, libtcod.BKGND_SET)
-								elif luck == 4:
-									libtcod.console_set_char_background(con, x, y, libtcod.grey, libtcod.BKGND_SET)
-								elif luck == 5:
-									libtcod.console_set_char_background(con, x, y, libtcod.blue, libtcod.BKGND_SET)
-								else:
-									libtcod.console_set_char_background(con, x, y, libtcod.light_flame, libtcod.BKGND_SET)
-							else:
-								libtcod.console_set_char_background(con, x, y, libtcod.light_flame, libtcod.BKGND_SET)
-							
-						elif strobe == 4:
-							dice = libtcod.random_get_int(0, 1, max_dist)
-							if dice <= distortion:
-								luck = libtcod.random_get_int(0, 1, 10)
-								if luck == 1:
-									libtcod.console_set_char_background(con, x, y, libtcod.yellow, libtcod.BKGND_SET)
-								elif luck == 2:
-									libtcod.console_set_char_background(con, x, y, libtcod.green, libtcod.BKGND_SET)
-								elif luck == 3:
-									libtcod.console_set_char_background(con, x, y, libtcod.flame, libtcod.BKGND_SET)
-								elif luck == 4:
-									libtcod.console_set_char_background(con, x, y, libtcod.grey, libtcod.BKGND_SET)
-								elif luck == 5:
-									libtcod.console_set_char_background(con, x, y, libtcod.blue, libtcod.BKGND_SET)
-								else:
-									libtcod.console_set_char_background(con, x, y, libtcod.light_pink, libtcod.BKGND_SET)
-							else:
-								libtcod.console_set_char_background(con, x, y, libtcod.light_pink, libtcod.BKGND_SET)
-							
-						else:
-							dice = libtcod.random_get_int(0, 1, max_dist)
-							if dice <= distortion and LG is False:
-								luck = libtcod.random_get_int(0, 1, 10)
-								if luck == 1:
-									libtcod.console_set_char_background(con, x, y, libtcod.yellow, libtcod.BKGND_SET)
-								elif luck == 2:
-									libtcod.console_set_char_background(con, x, y, libtcod.pink, libtcod.BKGND_SET)
-								elif luck == 3:
-									libtcod.console_set_char_background(con, x, y, libtcod.flame, libtcod.BKGND_SET)
-								elif luck == 4:
-									libtcod.console_set_char_background(con, x, y, libtcod.green, libtcod.BKGND_SET)
-								elif luck == 5:
-									libtcod.console_set_char_background(con, x, y, libtcod.blue, libtcod.BKGND_SET)
-								else:
-									libtcod.console_set_char_background(con, x, y, color_light_ground, libtcod.BKGND_SET)
-								LG = True
-							else:
-								libtcod.console_set_char_background(con, x, y, color_light_ground, libtcod.BKGND_SET)
-								LG = False
-							
-					map[x][y].explored = True
+		render_map()
 				
-	for object in objects:
-		if object != player:
-			object.draw()
-	player.draw()
+	#only what's in view gets drawn, and play_game() erases the same list
+	on_screen = spatial_index.on_top_in_view()
+	for object in on_screen:
+		object.draw()
 		
-	libtcod.console_blit(con, 0, 0, MAP_WIDTH, MAP_HEIGHT, 0, 0, 0)
+	if not headless:
+		libtcod.console_blit(con, 0, 0, MAP_WIDTH, MAP_HEIGHT, 0, 0, 0)
 	
 	#prepare to render GUI panel
 	libtcod.console_set_default_background(panel, libtcod.grey)
@@ -946,27 +1562,83 @@ def render_all():
 	libtcod.console_print_ex(panel, MSG_X + 2, 0, libtcod.BKGND_NONE, libtcod.LEFT, get_names_under_mouse())
 	
 	#blit the contents of "panel" to the root console
-	libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
+	if not headless:
+		libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
 	
+fov_key = None #(map version, x, y, radius) fov_map was last computed for
+fov_filled = None #(map, map version) fov_map was filled in from
+
+def fill_fov_map():
+	#copy the walls into fov_map. libtcod can clear a whole map to walls in one
+	#call, so only the open tiles need setting one by one
+	global fov_filled
+	libtcod.map_clear(fov_map, False, False)
+	w = map.width
+	for (i, (blocked, block_sight)) in enumerate(zip(map.blocked, map.block_sight)):
+		if not (blocked and block_sight):
+			libtcod.map_set_properties(fov_map, i % w, i // w, not block_sight, not blocked)
+	fov_filled = (map, map.version)
+
+def recompute_fov():
+	#the monsters look at fov_map on their turn, so it has to be up to date
+	#as soon as the player moves, not whenever the next frame gets drawn. it's
+	#only worked out again if the player or a wall actually moved
+	global fov_recompute, fov_key
+	if fov_filled != (map, map.version):
+		fill_fov_map()
+	key = (map.version, player.x, player.y, TORCH_RADIUS)
+	if key != fov_key:
+		libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+		fov_key = key
+	fov_recompute = True
+
+def line_points(x1, y1, x2, y2):
+	#the tiles on the straight line from (x1, y1) to (x2, y2), both ends
+	#included (Bresenham)
+	points = []
+	dx = abs(x2 - x1)
+	dy = -abs(y2 - y1)
+	sx = 1 if x1 < x2 else -1
+	sy = 1 if y1 < y2 else -1
+	err = dx + dy
+	while True:
+		points.append((x1, y1))
+		if x1 == x2 and y1 == y2:
+			return points
+		e2 = 2 * err
+		if e2 >= dy:
+			err += dy
+			x1 += sx
+		if e2 <= dx:
+			err += dx
+			y1 += sy
+
+def line_of_sight(x1, y1, x2, y2, radius=TORCH_RADIUS):
+	#can something at (x1, y1) see (x2, y2)? walks the line over the packed
+	#map, so a monster can look around without a FOV map of its own
+	dx = x2 - x1
+	dy = y2 - y1
+	if radius and dx * dx + dy * dy > radius * radius:
+		return False
+	block_sight = map.block_sight
+	w = map.width
+	for (x, y) in line_points(x1, y1, x2, y2)[1:-1]:
+		if block_sight[x + y * w]:
+			return False
+	return True
+
 def player_move_or_attack(dx, dy):
-	global fov_recompute
-	
 	#the coordinates the player is moving to/attacking
 	x = player.x + dx
 	y = player.y + dy
 	
-	target = None
-	for object in objects:
-		if object.fighter and object.x == x and object.y == y:
-			target = object
-			break
+	target = spatial_index.fighter_at(x, y)
 	
 	if target is not None:
 		player.fighter.attack(target)
-		fov_recompute = True
 	else:
 		player.move(dx, dy)
-		fov_recompute = True
+	recompute_fov()
 
 def menu(header, options, width):
 	if len(options) > 26: raise ValueError('Cannot have a menu with more than 26 options.')
@@ -996,11 +1668,12 @@ def menu(header, options, width):
 	#blit the contents of "window" to the root console
 	x = SCREEN_WIDTH/2 - width/2
 	y = SCREEN_HEIGHT/2 - height/2
-	libtcod.console_blit(window, 0, 0, width, height, 0, x, y, 0.9, 0.6)
+	if not headless:
+		libtcod.console_blit(window, 0, 0, width, height, 0, x, y, 0.9, 0.6)
 	
 	#present the root console to the player and wait for a key-press
-	libtcod.console_flush()
-	key = libtcod.console_wait_for_keypress(True)
+	flush()
+	key = wait_for_key()
 	
 	#convert ASCII code to an index
 	index = key.c - ord('a')
@@ -1016,7 +1689,7 @@ def inventory_menu(header):
 	#show a menu with each item of the inventory
 	if len(inventory) == 0:
 		options = ['...']
-		sarcasm = libtcod.random_get_int(0, 0, 100)
+		sarcasm = libtcod.random_get_int(flavor_rng, 0, 100)
 		if sarcasm <= 20: 
 			message('You are free from the burden of attachment as your inventory is empty', libtcod.dark_lime)
 		elif sarcasm <= 40 and sarcasm > 20: 
@@ -1037,6 +1710,37 @@ def inventory_menu(header):
 	if index is None or len(inventory) == 0: return None
 	return inventory[index].item	
 
+
+def flush():
+	#show the root console, unless there is none
+	if not headless:
+		libtcod.console_flush()
+	
+def poll_input(wait=False):
+	#put the next key/mouse event into the global key and mouse. with wait, a
+	#live game sleeps until there is one instead of coming back with nothing
+	if input_source is None:
+		read_events(key, mouse, wait)
+	else:
+		input_source.poll(key, mouse, wait)
+		
+def read_events(key, mouse, wait):
+	#fill in key and mouse from the window. with wait it blocks inside libtcod
+	#until there is an event, so an idle game uses no CPU. nothing on screen
+	#changes on its own (the strobe only rolls when the player moves), so there
+	#is never a reason to wake up early
+	mask = libtcod.EVENT_KEY_PRESS | libtcod.EVENT_MOUSE
+	if wait:
+		libtcod.sys_wait_for_event(mask, key, mouse, False)
+	else:
+		libtcod.sys_check_for_event(mask, key, mouse)
+		
+def wait_for_key():
+	#block until a key is pressed and return it
+	if input_source is None:
+		return libtcod.console_wait_for_keypress(True)
+	return input_source.wait_for_key()
+	
 		
 def handle_keys():
 	global key;
@@ -1084,8 +1788,8 @@ def handle_keys():
 			
 			if key_char == 'g':
 				#pick up item
-				for object in objects: #look for an item in tile
-					if object.x == player.x and object.y == player.y and object.item:
+				for object in spatial_index.at(player.x, player.y): #look for an item in tile
+					if object.item:
 						object.item.pick_up()
 						break
 			
@@ -1106,6 +1810,11 @@ def handle_keys():
 				if stairs.x == player.x and stairs.y == player.y:
 					next_level()
 					
+			if key_char == '>':
+				#go back down if player is on the down stairs
+				if downstairs and downstairs.x == player.x and downstairs.y == player.y:
+					previous_level()
+					
 			return 'didnt-take-turn'
 
 def target_monster(max_range=None):
@@ -1116,8 +1825,8 @@ def target_monster(max_range=None):
 						return None
 						
 					#return the first clicked monster or loop
-					for obj in objects:
-						if obj.x == x and obj.y == y and obj.fighter and obj != player:
+					for obj in spatial_index.at(x, y):
+						if obj.fighter and obj != player:
 							return obj
 			
 def target_tile(max_range=None):
@@ -1125,9 +1834,9 @@ def target_tile(max_range=None):
 	global key, mouse
 	while True:
 		#render the screen. this erases the inventory and shows the names of objects under the mouse
-		libtcod.console_flush()
-		libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE,key,mouse)
 		render_all()
+		flush()
+		poll_input(wait=True)
 		
 		(x, y) = (mouse.cx, mouse.cy)
 		
@@ -1145,8 +1854,9 @@ def get_names_under_mouse():
 	(x, y) = (mouse.cx, mouse.cy)
 	
 	#create a list with the names of all objects at the mouse's coordinates and in FOV
-	names = [obj.name for obj in objects
-		if obj.x == x and obj.y == y and libtcod.map_is_in_fov(fov_map, obj.x, obj.y)]
+	if not spatial_index.at(x, y) or not libtcod.map_is_in_fov(fov_map, x, y):
+		return ''
+	names = [obj.name for obj in spatial_index.at(x, y)]
 		
 	names = ', '.join(names)
 	return names.capitalize()
@@ -1163,32 +1873,30 @@ def player_death(player):
 	player.color = libtcod.darkest_grey
 
 
-def monster_death(monster):
+def distort():
+	#every fallen monster and used up item warps the Nexus a little more
 	global distortion
+	distortion = min(distortion + 1, max_dist)
+
+def monster_death(monster):
 	#transforms it into a corpse!
 	message('You have overcome ' + monster.name + '!', libtcod.orange)
 	monster.char = '%'
 	monster.color = libtcod.darkest_grey
-	monster.blocks = False
-	monster.fighter = None
-	monster.ai = None
+	spatial_index.set_blocks(monster, False)
+	keep_spare(monster.fighter)
+	keep_spare(monster.ai)
+	spatial_index.set_fighter(monster, None)
+	spatial_index.set_ai(monster, None)
 	monster.name = 'remains of ' + monster.name
-	monster.send_to_back()
-	distortion = distortion + 1
+	distort()
 	
 def closest_monster(max_range):
 		#find closest enemy, up to a maximum range, and in the player's FOV
-		closest_enemy = None
-		closest_dist = max_range + 1 #start with (slightly more than) max range
-		
-		for object in objects:
-			if object.fighter and not object == player and libtcod.map_is_in_fov(fov_map, object.x, object.y):
-				#calculate the distance between object and player
-				dist = player.distance_to(object)
-				if dist < closest_dist: #it's closer, sor emember it
-					closest_enemy = object
-					closest_dist = dist
-		return closest_enemy
+		found = spatial_index.nearest(player.x, player.y, max_range, exclude=player)
+		if found:
+			return found[0]
+		return None
 	
 def cast_heal():
 	#heal the player
@@ -1217,9 +1925,8 @@ def cast_glitch():
 	if monster is None: #no enemy found
 		return 'cancelled'
 	
-	old_ai = monster.ai
-	monster.ai = ConfusedMonster(old_ai)
-	monster.ai.owner = monster
+	spatial_index.set_ai(monster, ConfusedMonster(monster.ai))
+	ai_scheduler.wake(monster)
 	message('You download the glitching file into the ' + monster.name + '. The ' + monster.name + ' begins to behave erratically while spitting out binary nonsense.', libtcod.lighter_blue)
 	
 def cast_gravitywell():
@@ -1229,8 +1936,8 @@ def cast_gravitywell():
 	if x is None: return 'cancelled'
 	message('Hunks of metal go flying as a gravity well forms and tears things within ' + str(GRAV_RADIUS) + ' tiles asunder!', libtcod.darker_grey)
 	
-	for obj in objects:
-		if obj.distance(x, y) <= GRAV_RADIUS and obj.fighter:
+	for obj in spatial_index.in_radius(x, y, GRAV_RADIUS):
+		if obj.fighter:
 			message('Pieces of ' + obj.name + ' get torn off!', libtcod.flame)
 			obj.fighter.take_damage(GRAV_DAMAGE)
 			
@@ -1238,21 +1945,253 @@ def cast_gravitywell():
 #++++++++++++++THIS SHIT RIGHT HERE, THIS SHIT BE BLANDVVV.
 
 def next_level():
-	global dungeon_level
 	#advance to the next level
 	message('You head up the stairs, onto the next level of the Nexus.', libtcod.light_violet)
-	
-	dungeon_level += 1
-	
+	change_level(dungeon_level + 1)
+	
+def previous_level():
+	message('You head back down the stairs.', libtcod.light_violet)
+	change_level(dungeon_level - 1)
+	
+def change_level(level):
+	#put the current floor away in the cache and go to another one, taking
+	#it from the cache if the player has been there before
+	global dungeon_level, map, objects, stairs, downstairs, spatial_index, fov_map, fov_filled
+	
+	going_up = level > dungeon_level
+	objects.remove(player)
+	spatial_index.remove(player)
+	floor_cache.store(dungeon_level, Floor(map, objects, stairs, downstairs, spatial_index, fov_map))
+	
+	dungeon_level = level
+	floor = floor_cache.take(level)
+	if floor is None:
+		floor = take_pregenerated(level)
+	if floor is None:
+		make_map()
+		initialize_fov()
+		request_pregen()
+		return
+	
+	(map, objects, stairs, downstairs, spatial_index) = (floor.map, floor.objects, floor.stairs, floor.downstairs, floor.spatial_index)
+	#arrive on the stairs that lead back where we came from
+	arrival = downstairs if going_up else stairs
+	(player.x, player.y) = (arrival.x, arrival.y)
+	objects.append(player)
+	spatial_index.add(player)
+	if floor.fov_map is None:
+		initialize_fov()
+	else:
+		#the walls can't have changed while the player was away
+		fov_map = floor.fov_map
+		fov_filled = (map, map.version)
+		reset_view()
+	request_pregen()
+		
+#++++++++++++++FLOOR CACHE
+#floors the player has left stay in memory, most recently visited first, until
+#they add up to more than FLOOR_CACHE_BUDGET bytes. after that the oldest ones
+#are written to FLOOR_DIR in the save format and read back when needed.
+#every autosave snapshot also has the cached floors written there by the
+#autosave thread (they stay in memory too), and a file is kept after it's read
+#back, so after a crash the snapshot always finds the floors the player had
+#already been to
+
+FLOOR_CACHE_BUDGET = 4 * 1024 * 1024
+FLOOR_DIR = 'savegame.floors'
+
+#rough cost of one object and its components, for the budget
+OBJECT_BYTES = 600
+
+class Floor:
+	#everything that belongs to one level of the dungeon, except the player
+	def __init__(self, map, objects, stairs, downstairs, spatial_index, fov_map):
+		self.map = map
+		self.objects = objects
+		self.stairs = stairs
+		self.downstairs = downstairs
+		self.spatial_index = spatial_index
+		self.fov_map = fov_map
+		
+	def size(self):
+		#the packed map, about as much again for the libtcod FOV map, and the objects
+		tiles = self.map.width * self.map.height
+		return 3 * tiles + (3 * tiles if self.fov_map is not None else 0) + OBJECT_BYTES * len(self.objects)
+		
+class FloorCache:
+	def __init__(self, budget=FLOOR_CACHE_BUDGET):
+		self.budget = budget
+		self.floors = collections.OrderedDict() #level -> Floor, least recently left first
+		self.used = 0
+		self.saved = set() #levels whose file in FLOOR_DIR is up to date, or queued to be
+		
+	def store(self, level, floor):
+		#the player was just there, so its file (if any) is out of date
+		self.floors[level] = floor
+		self.saved.discard(level)
+		self.used += floor.size()
+		while self.used > self.budget and len(self.floors) > 1:
+			(old_level, old_floor) = self.floors.popitem(last=False)
+			self.used -= old_floor.size()
+			self.spill(old_level, old_floor)
+			
+	def take(self, level):
+		#the floor for this level, or None if it was never visited
+		if level in self.floors:
+			floor = self.floors.pop(level)
+			self.used -= floor.size()
+			return floor
+		if autosaver is not None:
+			autosaver.wait() #the floor's file may still be on its way to disk
+		path = floor_path(level)
+		if os.path.exists(path):
+			#the file stays until the floor is written again, the last snapshot
+			#may still need it
+			with open(path, 'rb') as file:
+				return decode_floor(file.read())
+		return None
+		
+	def write(self, level, floor):
+		if not os.path.isdir(FLOOR_DIR):
+			os.makedirs(FLOOR_DIR)
+		write_file(floor_path(level), encode_floor(floor))
+		self.saved.add(level)
+		
+	def unsaved(self):
+		#(level, packed floor) for every cached floor whose file is out of date,
+		#for whoever writes them to mark as saved. the floors stay in memory
+		found = []
+		for (level, floor) in self.floors.items():
+			if level not in self.saved:
+				found.append((level, encode_floor(floor)))
+				self.saved.add(level)
+		return found
+		
+	def spill(self, level, floor):
+		if level not in self.saved:
+			self.write(level, floor)
+		#the floor only lives on disk now, its objects can be reused
+		for obj in floor.objects:
+			recycle(obj)
+		
+	def spill_all(self):
+		#put every cached floor on disk, so a saved game can go back to them
+		for (level, floor) in self.floors.items():
+			self.spill(level, floor)
+		self.floors.clear()
+		self.used = 0
+		
+def floor_path(level):
+	return os.path.join(FLOOR_DIR, 'level%d.sav' % level)
+	
+def clear_floors():
+	#forget the floors of the last game
+	global floor_cache
+	floor_cache = FloorCache()
+	if os.path.isdir(FLOOR_DIR):
+		for name in os.listdir(FLOOR_DIR):
+			os.remove(os.path.join(FLOOR_DIR, name))
+	
+#++++++++++++++PRE-GENERATION
+#while the player explores a level, a worker process builds the next one from
+#its level_seed() (so it is exactly what make_map() would have built) and hands
+#it back packed like a spilled floor
+
+pregen_pool = None
+pregen_pending = None #(level, AsyncResult)
+
+def generation_settings():
+	#what the worker needs to know to build the same floor as this process
+	return {'MAP_WIDTH': MAP_WIDTH, 'MAP_HEIGHT': MAP_HEIGHT, 'MAX_ROOMS': MAX_ROOMS,
+		'ROOM_MIN_SIZE': ROOM_MIN_SIZE, 'ROOM_MAX_SIZE': ROOM_MAX_SIZE,
+		'MAX_ROOM_MONSTERS': MAX_ROOM_MONSTERS, 'MAX_ROOM_ITEMS': MAX_ROOM_ITEMS,
+		'MAP_GENERATOR': MAP_GENERATOR, 'game_seed': game_seed}
+
+def pregenerate_floor(level, settings):
+	#runs in the worker process
+	global dungeon_level, player
+	globals().update(settings)
+	dungeon_level = level
+	player = Object(0, 0, '@', 'player', libtcod.white, blocks=True)
 	make_map()
-	initialize_fov()
+	objects.remove(player)
+	return encode_floor(Floor(map, objects, stairs, downstairs, spatial_index, None))
+
+def start_pregen():
+	global pregen_pool
+	if pregen_pool is None:
+		pregen_pool = multiprocessing.Pool(1)
+	request_pregen()
+
+def stop_pregen():
+	global pregen_pool, pregen_pending
+	if pregen_pool is not None:
+		pregen_pool.terminate()
+		pregen_pool = None
+	pregen_pending = None
+
+def request_pregen():
+	#start building the level above this one, unless it exists already
+	global pregen_pending
+	level = dungeon_level + 1
+	if pregen_pool is None or level in floor_cache.floors or os.path.exists(floor_path(level)):
+		return
+	if pregen_pending is not None and pregen_pending[0] == level:
+		return
+	pregen_pending = (level, pregen_pool.apply_async(pregenerate_floor, (level, generation_settings())))
+
+def take_pregenerated(level):
+	#the floor the worker built for this level, or None
+	global pregen_pending
+	if pregen_pending is None or pregen_pending[0] != level:
+		return None
+	(level, result) = pregen_pending
+	pregen_pending = None
+	try:
+		return decode_floor(result.get(), new_oids=True)
+	except Exception:
+		return None #something went wrong over there, build it here instead
+	
+def encode_floor(floor):
+	def oid(obj):
+		return obj.oid if obj else 0
+	sections = [
+		(b'TILE', encode_tiles(floor.map)),
+		(b'FLOR', struct.pack('<II', oid(floor.stairs), oid(floor.downstairs))),
+		] + encode_entities(floor.objects, [])
+	return pack_sections(floor.map.width, floor.map.height, sections)
+	
+def decode_floor(data, new_oids=False):
+	#new_oids is for floors built in another process, whose oids mean nothing here
+	global last_oid
+	(width, height, sections) = unpack_sections(data)
+	(stairs_oid, downstairs_oid) = struct.unpack_from('<II', sections[b'FLOR'])
+	(objects, carried) = decode_entities(sections)
+	by_oid = dict((obj.oid, obj) for obj in objects)
+	if new_oids:
+		for obj in objects:
+			last_oid += 1
+			obj.oid = last_oid
+	index = SpatialIndex()
+	index.rebuild(objects)
+	return Floor(decode_tiles(sections[b'TILE'], width, height), objects,
+		by_oid.get(stairs_oid), by_oid.get(downstairs_oid), index, None)
 
 
 			
-def new_game():
-	global player, inventory, game_msgs, game_state, first_time, dungeon_level
+def new_game(seed=None):
+	#the same seed gives the same game, as long as the player does the same things
+	global player, inventory, game_msgs, game_state, first_time, dungeon_level, game_seed, distortion
+	global turn_count
 	
 	dungeon_level = 1
+	distortion = 0
+	if seed is None:
+		seed = libtcod.random_get_int(0, 0, 0x7fffffff)
+	game_seed = seed
+	seed_rngs(game_seed)
+	roll_spell_powers()
+	clear_floors()
 	
 	#create object representing the player
 	fighter_component = Fighter(hp=30, defense=2, power=6, energy=20, death_function=player_death)
@@ -1264,6 +2203,7 @@ def new_game():
 	
 	game_state = 'playing'
 	first_time = True
+	turn_count = 0
 	inventory = []
 	game_msgs = []
 	
@@ -1271,59 +2211,116 @@ def new_game():
 	message('Welcome to the Nexus, brave automaton. Will you learn the secrets of this place or perish like so many others at the hands of the mysterious Nexus?', libtcod.light_blue)
 	
 def initialize_fov():
-	global fov_recompute, fov_map
-	fov_recompute = True
+	global fov_map
 	
-	fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-	for y in range(MAP_HEIGHT):
-		for x in range(MAP_WIDTH):
-			libtcod.map_set_properties(fov_map, x, y, not map[x][y].block_sight, not map[x][y].blocked)
+	fov_map = libtcod.map_new(map.width, map.height)
+	fill_fov_map()
+	reset_view()
+	
+def reset_view():
+	#we're looking at a different map now
+	global full_redraw, fov_key, on_screen
+	ai_scheduler.rebuild(spatial_index)
+	fov_key = None
+	on_screen = []
+	recompute_fov()
+	full_redraw = True #the console gets cleared below, so repaint every tile
 	
 	libtcod.console_clear(con)
 
-def play_game():
-	global key, mouse
+def play_game(record=None):
+	#record is a file to write a recording of the game to, see Recorder
+	global key, mouse, input_source
 	
 	player_action = None
+	turns_since_autosave = 0
 
 	mouse = libtcod.Mouse()
 	key = libtcod.Key()
+	
+	if record is not None:
+		input_source = Recorder(game_seed)
+	
+	start_autosave()
+	start_pregen()
 
-	while not libtcod.console_is_window_closed():
+	try:
+		while not libtcod.console_is_window_closed():
+			#the screen only changes when something happens, so draw it and then
+			#sleep until the player does something
+			render_all()
 
-		libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE,key,mouse)
+			flush()
+			
+			#erase the objects drawn this frame, before they move
+			for object in on_screen:
+				object.clear()
 
-		render_all()
+			poll_input(wait=True)
+			
+			#handle keys and exit game if needed
+			player_action = handle_keys()
+			if player_action == 'exit':
+				stop_pregen()
+				stop_autosave()
+				save_game()
+				break
+			
+			if game_state == 'playing' and player_action != 'didnt-take-turn':
+				take_monster_turns()
+				
+				turns_since_autosave += 1
+				if turns_since_autosave >= AUTOSAVE_TURNS:
+					autosave()
+					turns_since_autosave = 0
+	finally:
+		#keep the recording even if the game crashed, that's when it's wanted most
+		if record is not None:
+			input_source.save(record)
+			input_source = None
+	
+def take_monster_turns():
+	#let the monsters that are awake act once after the player's turn
+	global turn_count
+	turn_count += 1
+	ai_scheduler.run()
+	
+def roll_spell_powers():
+	#how strong the spells are this game
+	global HEAL_AMOUNT, CORRUPT_DAMAGE, GLITCH_NUM_TURNS, GRAV_RADIUS, GRAV_DAMAGE
+	HEAL_AMOUNT = libtcod.random_get_int(combat_rng, *HEAL_AMOUNT_ROLL)
+	CORRUPT_DAMAGE = libtcod.random_get_int(combat_rng, *CORRUPT_DAMAGE_ROLL)
+	GLITCH_NUM_TURNS = libtcod.random_get_int(combat_rng, *GLITCH_NUM_TURNS_ROLL)
+	GRAV_RADIUS = libtcod.random_get_int(combat_rng, *GRAV_RADIUS_ROLL)
+	GRAV_DAMAGE = libtcod.random_get_int(combat_rng, *GRAV_DAMAGE_ROLL)
+	
+def init_window():
+	#load the font, open the game window and make the consoles we draw on
+	global con, panel
+	libtcod.console_set_custom_font('prestige12x12_gs_tc.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
 
-		libtcod.console_flush()
-		
-		#erase all objects at their old locations, before they move
-		for object in objects:
-			object.clear()
+	libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'GEAR: WIZARD OF THE TECHNO NEXUS', False)
+	libtcod.sys_set_fps(LIMIT_FPS)
+	con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
 
-		
-		#handle keys and exit game if needed
-		player_action = handle_keys()
-		if player_action == 'exit':
-			save_game()
-			break
-		
-		if game_state == 'playing' and player_action != 'didnt-take-turn':
-			for object in objects:
-				if object.ai:
-					object.ai.take_turn()
+	panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
 	
+title_image = None
+
 def main_menu():
-	img = libtcod.image_load('GEAR.png')
+	global title_image
+	#the title picture is only loaded once somebody actually looks at the menu
+	if title_image is None:
+		title_image = libtcod.image_load('GEAR.png')
 	
 	while not libtcod.console_is_window_closed():
-		libtcod.image_blit_2x(img, 0, 0, 0)
+		libtcod.image_blit_2x(title_image, 0, 0, 0)
 		
 		choice = menu('', ['New Game', 'Continue Game', 'Quit'], 24)
 		
 		if choice == 0:
 			new_game()
-			play_game()
+			play_game(recording_file)
 		
 		if choice == 1:
 			try:
@@ -1336,52 +2333,725 @@ def main_menu():
 		elif choice == 2:
 			break
 	
+class ScriptedInput:
+	#plays back a list of inputs instead of reading the keyboard. an entry is a
+	#libtcod key code (libtcod.KEY_UP...), a character ('g', 'i', 'a'...), None
+	#for a frame with no input, or ('click', x, y) / ('rclick', x, y) for the
+	#mouse. when the script runs out it keeps pressing Escape
+	def __init__(self, inputs):
+		self.inputs = list(inputs)
+		self.position = 0
+		
+	def next(self):
+		if self.position >= len(self.inputs):
+			return libtcod.KEY_ESCAPE
+		entry = self.inputs[self.position]
+		self.position += 1
+		return entry
+		
+	def poll(self, key, mouse, wait=False):
+		#the next input is always ready, there's nothing to wait for
+		set_input(self.next(), key, mouse)
+		
+	def wait_for_key(self):
+		key = libtcod.Key()
+		entry = self.next()
+		while isinstance(entry, tuple) or entry is None: #menus only care about keys
+			entry = self.next()
+		set_input(entry, key, libtcod.Mouse())
+		return key
+		
+class RandomInput:
+	#mashes random keys, for soak tests and benchmarks. never presses Escape on
+	#its own, but clicks around (and sometimes right-clicks) so targeting ends
+	def __init__(self, keys=None, seed=None):
+		#with a seed it always presses the same keys
+		self.rng = 0
+		if seed is not None:
+			self.rng = libtcod.random_new_from_seed(seed)
+		if keys is None:
+			keys = [libtcod.KEY_UP, libtcod.KEY_DOWN, libtcod.KEY_LEFT, libtcod.KEY_RIGHT,
+				libtcod.KEY_KP7, libtcod.KEY_KP9, libtcod.KEY_KP1, libtcod.KEY_KP3,
+				'g', 'g', 'i', 'a', 'b', '<']
+		self.keys = keys
+		
+	def next(self):
+		dice = libtcod.random_get_int(self.rng, 0, 9)
+		if dice == 0:
+			x = player.x + libtcod.random_get_int(self.rng, -TORCH_RADIUS, TORCH_RADIUS)
+			y = player.y + libtcod.random_get_int(self.rng, -TORCH_RADIUS, TORCH_RADIUS)
+			return ('click', min(max(x, 0), map.width - 1), min(max(y, 0), map.height - 1))
+		if dice == 1:
+			return ('rclick', 0, 0)
+		return self.keys[libtcod.random_get_int(self.rng, 0, len(self.keys) - 1)]
+		
+	def poll(self, key, mouse, wait=False):
+		#the next input is always ready, there's nothing to wait for
+		set_input(self.next(), key, mouse)
+		
+	def wait_for_key(self):
+		key = libtcod.Key()
+		set_input(self.keys[libtcod.random_get_int(self.rng, 0, len(self.keys) - 1)], key, libtcod.Mouse())
+		return key
+		
+def set_input(entry, key, mouse):
+	#turn a script entry into libtcod key and mouse state
+	key.vk = libtcod.KEY_NONE
+	key.c = 0
+	key.lalt = False
+	mouse.lbutton_pressed = False
+	mouse.rbutton_pressed = False
+	
+	if isinstance(entry, tuple):
+		(button, mouse.cx, mouse.cy) = entry
+		if button == 'click':
+			mouse.lbutton_pressed = True
+		else:
+			mouse.rbutton_pressed = True
+	elif isinstance(entry, str):
+		key.vk = libtcod.KEY_CHAR
+		key.c = ord(entry)
+	elif entry is not None:
+		key.vk = entry
+		
+def start_headless():
+	#get ready to run without a window: off-screen consoles only, no root console
+	global headless, con, panel, key, mouse, FLOOR_DIR
+	if not headless:
+		#new_game() clears FLOOR_DIR, and bench.py or a replay run from the game's
+		#directory mustn't take the floors of the player's saved game with it
+		FLOOR_DIR = tempfile.mkdtemp(prefix='gear-floors-')
+		atexit.register(shutil.rmtree, FLOOR_DIR, True)
+	headless = True
+	con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
+	panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+	key = libtcod.Key()
+	mouse = libtcod.Mouse()
+	
+def run_headless(inputs, turns, render=True, timings=None):
+	#play the current game for up to the given number of frames with keys from
+	#inputs (a ScriptedInput, RandomInput...), monsters and all. stops early if
+	#the input says Escape or the player dies. returns how many player turns
+	#were actually taken. if timings is a list, the seconds each player turn
+	#took get appended to it
+	global input_source
+	
+	input_source = inputs
+	taken = 0
+	try:
+		for frame in range(turns):
+			start = timeit.default_timer()
+			poll_input()
+			if render:
+				render_all()
+				
+			player_action = handle_keys()
+			if player_action == 'exit' or game_state == 'dead':
+				break
+				
+			if game_state == 'playing' and player_action != 'didnt-take-turn':
+				take_monster_turns()
+				taken += 1
+				if timings is not None:
+					timings.append(timeit.default_timer() - start)
+	finally:
+		input_source = None
+	return taken
+	
+#++++++++++++++SAVE FILES
+#a save is a snapshot (SAVE_FILE) plus a journal of autosaves made since then
+#(JOURNAL_FILE). a snapshot is a small header, a table of contents and then the
+#sections it lists:
+#
+#	'GEAR' version width height section_count
+#	section_count x (tag, offset, length)
+#	sections...
+#
+#everything is little-endian and every section sits at a fixed offset, so a
+#loader (or mmap) can jump straight to the part it wants. the map is stored as
+#one bit per tile per flag, and entities as a table with one column per field
+#plus one table per component type
+
+SAVE_FILE = 'savegame.sav'
+JOURNAL_FILE = 'savegame.jnl'
+SAVE_MAGIC = b'GEAR'
+SAVE_VERSION = 5
+
+#autosave every this many player turns, and fold the journal back into a fresh
+#snapshot once it holds this many autosaves
+AUTOSAVE_TURNS = 10
+JOURNAL_LIMIT = 50
+
+#functions and AI classes are saved as their position in these lists
+DEATH_FUNCTIONS = [None, player_death, monster_death]
+USE_FUNCTIONS = [None, cast_heal, cast_glitch, cast_gravitywell, cast_corrupt]
+AI_KINDS = [None, BasicMonster, ConfusedMonster]
+GAME_STATES = ['playing', 'dead']
+
+#the 8 tile flags each byte of a bit-packed plane stands for, and back
+BIT_PATTERNS = [bytes(bytearray((b >> k) & 1 for k in range(8))) for b in range(256)]
+PATTERN_BITS = dict((pattern, b) for (b, pattern) in enumerate(BIT_PATTERNS))
+
+def pack_bits(flags):
+	#one bit per tile instead of one byte
+	flags = bytes(flags) + b'\0' * (-len(flags) % 8)
+	return bytes(bytearray(PATTERN_BITS[flags[i:i + 8]] for i in range(0, len(flags), 8)))
+
+def unpack_bits(bits, count):
+	return bytearray(b''.join([BIT_PATTERNS[b] for b in bytearray(bits)])[:count])
+
+def text_bytes(text):
+	if isinstance(text, bytes):
+		return text
+	return text.encode('utf-8')
+
+def bytes_text(data):
+	if str is bytes:
+		return data
+	return data.decode('utf-8')
+
+def pack_columns(types, rows):
+	#a table as a row count followed by one packed array per column. types has
+	#one struct letter per column
+	data = [struct.pack('<I', len(rows))]
+	for (n, kind) in enumerate(types):
+		data.append(struct.pack('<%d%s' % (len(rows), kind), *[row[n] for row in rows]))
+	return b''.join(data)
+
+def unpack_columns(types, data, offset=0):
+	#returns (list of rows, offset just past the table)
+	(count,) = struct.unpack_from('<I', data, offset)
+	offset += 4
+	columns = []
+	for kind in types:
+		fmt = '<%d%s' % (count, kind)
+		columns.append(struct.unpack_from(fmt, data, offset))
+		offset += struct.calcsize(fmt)
+	return (list(zip(*columns)) if columns else [], offset)
+
+def pack_strings(strings):
+	strings = [text_bytes(s) for s in strings]
+	return pack_columns('H', [(len(s),) for s in strings]) + b''.join(strings)
+
+def unpack_strings(data, offset=0):
+	(lengths, offset) = unpack_columns('H', data, offset)
+	strings = []
+	for (length,) in lengths:
+		strings.append(bytes_text(data[offset:offset + length]))
+		offset += length
+	return (strings, offset)
+
+def pack_sections(width, height, sections):
+	#sections is a list of (4 letter tag, bytes)
+	header = struct.pack('<4sHHHH', SAVE_MAGIC, SAVE_VERSION, width, height, len(sections))
+	offset = len(header) + len(sections) * struct.calcsize('<4sII')
+	contents = []
+	for (tag, data) in sections:
+		contents.append(struct.pack('<4sII', tag, offset, len(data)))
+		offset += len(data)
+	return b''.join([header] + contents + [data for (tag, data) in sections])
+
+def unpack_sections(data):
+	#returns (width, height, {tag: bytes})
+	(magic, version, width, height, count) = struct.unpack_from('<4sHHHH', data, 0)
+	if magic != SAVE_MAGIC:
+		raise ValueError('not a GEAR save')
+	if version != SAVE_VERSION:
+		raise ValueError('save is version %d, this game reads version %d' % (version, SAVE_VERSION))
+	sections = {}
+	entry = struct.calcsize('<4sHHHH')
+	for n in range(count):
+		(tag, offset, length) = struct.unpack_from('<4sII', data, entry)
+		sections[tag] = data[offset:offset + length]
+		entry += struct.calcsize('<4sII')
+	return (width, height, sections)
+
+def encode_tiles(map):
+	return pack_bits(map.blocked) + pack_bits(map.block_sight) + pack_bits(map.explored)
+
+def decode_tiles(data, width, height):
+	map = Map(width, height)
+	plane = (width * height + 7) // 8
+	map.blocked = unpack_bits(data[:plane], width * height)
+	map.block_sight = unpack_bits(data[plane:2 * plane], width * height)
+	map.explored = unpack_bits(data[2 * plane:3 * plane], width * height)
+	return map
+
+def encode_entities(on_map, carried):
+	#the entity table plus the component tables for the objects on the map and
+	#the ones carried in the inventory. an entity's id is its row number
+	entities = []
+	fighters = []
+	ais = []
+	items = []
+	for (id, obj) in enumerate(on_map + carried):
+		flags = (1 if obj.blocks else 0) | (2 if id >= len(on_map) else 0)
+		entities.append((obj.oid, obj.x, obj.y, ord(obj.char), obj.color.r, obj.color.g, obj.color.b, flags))
+		if obj.fighter:
+			f = obj.fighter
+			fighters.append((id, f.hp, f.max_hp, f.defense, f.power, f.energy, f.max_energy,
+				DEATH_FUNCTIONS.index(f.death_function), f.speed))
+		if obj.ai:
+			if isinstance(obj.ai, ConfusedMonster):
+				#a monster glitched twice only remembers the AI it will end up with
+				old_ai = obj.ai.old_ai
+				while isinstance(old_ai, ConfusedMonster):
+					old_ai = old_ai.old_ai
+				ais.append((id, AI_KINDS.index(ConfusedMonster), AI_KINDS.index(old_ai.__class__), obj.ai.num_turns))
+			else:
+				ais.append((id, AI_KINDS.index(obj.ai.__class__), 0, 0))
+		if obj.item:
+			items.append((id, USE_FUNCTIONS.index(obj.item.use_function), 1 if obj.item.multi_use else 0))
+	return [
+		(b'ENTS', pack_columns('IhhBBBBB', entities) + pack_strings([obj.name for obj in on_map + carried])),
+		(b'FGHT', pack_columns('IiiiiiiBH', fighters)),
+		(b'AI  ', pack_columns('IBBi', ais)),
+		(b'ITEM', pack_columns('IBB', items)),
+		]
+
+def decode_entities(sections):
+	#returns (objects on the map, inventory)
+	global last_oid
+	(entities, offset) = unpack_columns('IhhBBBBB', sections[b'ENTS'])
+	(names, offset) = unpack_strings(sections[b'ENTS'], offset)
+	(fighters, offset) = unpack_columns('IiiiiiiBH', sections[b'FGHT'])
+	(ais, offset) = unpack_columns('IBBi', sections[b'AI  '])
+	(items, offset) = unpack_columns('IBB', sections[b'ITEM'])
+	
+	fighter_of = {}
+	for (id, hp, max_hp, defense, power, energy, max_energy, death, speed) in fighters:
+		fighter = make(Fighter, hp=max_hp, defense=defense, power=power, energy=max_energy, death_function=DEATH_FUNCTIONS[death], speed=speed)
+		fighter.hp = hp
+		fighter.energy = energy
+		fighter_of[id] = fighter
+	ai_of = {}
+	for (id, kind, old_kind, num_turns) in ais:
+		if AI_KINDS[kind] is ConfusedMonster:
+			ai_of[id] = make(ConfusedMonster, make(AI_KINDS[old_kind]), num_turns)
+		else:
+			ai_of[id] = make(AI_KINDS[kind])
+	item_of = {}
+	for (id, use, multi_use) in items:
+		item_of[id] = make(Item, use_function=USE_FUNCTIONS[use], multi_use=multi_use == 1)
+	
+	on_map = []
+	carried = []
+	for (id, (oid, x, y, char, r, g, b, flags)) in enumerate(entities):
+		obj = make(Object, x, y, chr(char), names[id], libtcod.Color(r, g, b), blocks=(flags & 1) == 1,
+			fighter=fighter_of.get(id), ai=ai_of.get(id), item=item_of.get(id))
+		obj.oid = oid
+		last_oid = max(last_oid, oid)
+		if isinstance(obj.ai, ConfusedMonster):
+			obj.ai.old_ai.owner = obj
+		if flags & 2:
+			carried.append(obj)
+		else:
+			on_map.append(obj)
+	return (on_map, carried)
+
+def write_file(path, data):
+	#write to a temporary file first so a crash never leaves half a save behind
+	temp = path + '.tmp'
+	with open(temp, 'wb') as file:
+		file.write(data)
+	if os.path.exists(path):
+		os.remove(path)
+	os.rename(temp, path)
+
+def encode_game():
+	#the GAME section. objects are referred to by oid, 0 means none
+	game = struct.pack('<IIIIiiiiiiiB', player.oid, stairs.oid if stairs else 0,
+		downstairs.oid if downstairs else 0, game_seed, dungeon_level, distortion,
+		HEAL_AMOUNT, CORRUPT_DAMAGE, GLITCH_NUM_TURNS, GRAV_RADIUS, GRAV_DAMAGE,
+		GAME_STATES.index(game_state))
+	return (b'GAME', game)
+
+def decode_game(data):
+	#set the game globals from a GAME section, returns the oids of the player,
+	#the stairs and the stairs down
+	global dungeon_level, distortion, game_state, game_seed
+	global HEAL_AMOUNT, CORRUPT_DAMAGE, GLITCH_NUM_TURNS, GRAV_RADIUS, GRAV_DAMAGE
+	(player_oid, stairs_oid, downstairs_oid, game_seed, dungeon_level, distortion,
+		HEAL_AMOUNT, CORRUPT_DAMAGE, GLITCH_NUM_TURNS, GRAV_RADIUS, GRAV_DAMAGE,
+		state) = struct.unpack_from('<IIIIiiiiiiiB', data)
+	game_state = GAME_STATES[state]
+	return (player_oid, stairs_oid, downstairs_oid)
+
+def encode_messages():
+	return (b'MSGS', pack_columns('BBB', [(color.r, color.g, color.b) for (line, color) in game_msgs]) +
+		pack_strings([line for (line, color) in game_msgs]))
+
+def decode_messages(data):
+	(colors, offset) = unpack_columns('BBB', data)
+	(lines, offset) = unpack_strings(data, offset)
+	return [(line, libtcod.Color(r, g, b)) for (line, (r, g, b)) in zip(lines, colors)]
+
+def encode_save():
+	#a full snapshot of the game
+	sections = [
+		encode_game(),
+		(b'JRNL', struct.pack('<I', save_generation)),
+		(b'TILE', encode_tiles(map)),
+		encode_messages(),
+		] + encode_entities(objects, inventory)
+	return pack_sections(map.width, map.height, sections)
+
 def save_game():
-	global distortion
-	#open a new empty shelve to write game data
-	file = shelve.open('savegame', 'n')
-	file['map'] = map
-	file['objects'] = objects
-	file['player_index'] = objects.index(player)
-	file['inventory'] = inventory
-	file['game_msgs'] = game_msgs
-	file['game_state'] = game_state
-	file['distortion'] = distortion
-	file['stairs_index'] = object.index(stairs)
-	file['dungeon_level'] = dungeon_level
-	file.close()
+	#write the whole game to SAVE_FILE. the journal only holds changes made
+	#after an older snapshot, so it goes away
+	global save_generation
+	save_generation += 1
+	floor_cache.spill_all()
+	write_file(SAVE_FILE, encode_save())
+	if os.path.exists(JOURNAL_FILE):
+		os.remove(JOURNAL_FILE)
 
 def load_game():
-	global map, objects, player, inventory, game_msgs, game_state, distortion, first_time
-	global stairs, dungeon_level
-	
-	file = shelve.open('savegame', 'r')
-	map = file['map']
-	objects = file['objects']
-	player = objects[file['player_index']]
-	inventory = file['inventory']
-	game_msgs = file['game_msgs']
-	game_state = file['game_state']
-	distortion = file['distortion']
-	stairs = objects[file['stairs_index']]
-	dungeon_level = file['dungeon level']
+	global map, objects, player, inventory, game_msgs, first_time
+	global stairs, downstairs, spatial_index, save_generation, floor_cache
+	
+	with open(SAVE_FILE, 'rb') as file:
+		data = file.read()
+	(width, height, sections) = unpack_sections(data)
+	
+	(player_oid, stairs_oid, downstairs_oid) = decode_game(sections[b'GAME'])
+	(save_generation,) = struct.unpack('<I', sections[b'JRNL'])
+	map = decode_tiles(sections[b'TILE'], width, height)
+	(objects, inventory) = decode_entities(sections)
+	game_msgs = decode_messages(sections[b'MSGS'])
+	by_oid = dict((obj.oid, obj) for obj in objects + inventory)
+	
+	#if the game didn't get to exit cleanly, replay the autosaves made after
+	#the snapshot
+	for record in read_journal(save_generation):
+		(width, height, sections) = unpack_sections(record)
+		(player_oid, stairs_oid, downstairs_oid) = decode_game(sections[b'GAME'])
+		(explored, offset) = unpack_columns('I', sections[b'EXPL'])
+		for (i,) in explored:
+			map.explored[i] = 1
+		(on_map, carried) = decode_entities(sections)
+		for obj in on_map + carried:
+			by_oid[obj.oid] = obj
+		(order, offset) = unpack_columns('I', sections[b'ORDR'])
+		(carried, offset) = unpack_columns('I', sections[b'ORDR'], offset)
+		objects = [by_oid[oid] for (oid,) in order]
+		inventory = [by_oid[oid] for (oid,) in carried]
+		game_msgs = decode_messages(sections[b'MSGS'])
+	
+	player = by_oid[player_oid]
+	stairs = by_oid.get(stairs_oid)
+	downstairs = by_oid.get(downstairs_oid)
 	first_time = False
-	file.close()
+	seed_rngs(game_seed)
+	
+	#floors visited before the save are waiting in FLOOR_DIR
+	floor_cache = FloorCache()
 	
+	spatial_index = SpatialIndex()
+	spatial_index.rebuild(objects)
 	initialize_fov()
 	
+#++++++++++++++AUTOSAVE
+#every AUTOSAVE_TURNS turns the changes since the last autosave (objects that
+#moved, got hurt, were picked up... tiles that got explored) are appended to
+#JOURNAL_FILE as one record:
+#
+#	length crc32 generation, then the record, laid out like a snapshot
+#
+#generation says which snapshot the record builds on. records from an older
+#snapshot, or a record cut short by a crash, are ignored when loading.
+#all the disk work happens on a background thread
 
+save_generation = 0
+autosaver = None
 
-#main loop all up in dis
-#u don't even kno
-#this code be fresh and poppin
+class AutosaveWriter(threading.Thread):
+	#writes snapshots and journal records in the order they are handed over,
+	#so the game loop never waits for the disk
+	def __init__(self):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.jobs = queue.Queue()
+		self.error = None
+		
+	def run(self):
+		while True:
+			(job, data) = self.jobs.get()
+			try:
+				if job == 'floor':
+					(level, floor) = data
+					if not os.path.isdir(FLOOR_DIR):
+						os.makedirs(FLOOR_DIR)
+					write_file(floor_path(level), floor)
+				elif job == 'snapshot':
+					write_file(SAVE_FILE, data)
+					open(JOURNAL_FILE, 'wb').close()
+				elif job == 'record':
+					with open(JOURNAL_FILE, 'ab') as file:
+						file.write(data)
+						file.flush()
+						os.fsync(file.fileno())
+			except (IOError, OSError) as e:
+				self.error = e #the next snapshot gets another go at it
+			finally:
+				self.jobs.task_done()
+			if job == 'stop':
+				return
+				
+	def submit(self, job, data=None):
+		self.jobs.put((job, data))
+		
+	def wait(self):
+		#wait for everything handed over so far to be written
+		self.jobs.join()
+		
+	def stop(self):
+		#wait for everything handed over so far to be on disk
+		self.submit('stop')
+		self.join()
+
+def start_autosave():
+	global autosaver
+	if autosaver is None:
+		autosaver = AutosaveWriter()
+		autosaver.start()
+	compact_autosave()
+
+def stop_autosave():
+	global autosaver
+	if autosaver is not None:
+		autosaver.stop()
+		autosaver = None
+
+def object_state(obj):
+	#everything about an object that goes into a save, to spot what changed
+	state = (obj.x, obj.y, obj.char, obj.name, obj.blocks, obj.color.r, obj.color.g, obj.color.b)
+	if obj.fighter:
+		state += (obj.fighter.hp, obj.fighter.max_hp, obj.fighter.defense, obj.fighter.power, obj.fighter.energy)
+	if obj.ai:
+		state += (obj.ai.__class__, getattr(obj.ai, 'num_turns', None))
+	if obj.item:
+		state += (obj.item.use_function, obj.item.multi_use)
+	return state
+
+def checkpoint():
+	#remember what the game looks like right now, autosaves record the difference
+	global checkpoint_map, checkpoint_explored, checkpoint_states
+	checkpoint_map = map
+	checkpoint_explored = bytes(map.explored)
+	checkpoint_states = dict((obj.oid, object_state(obj)) for obj in objects + inventory)
+
+def compact_autosave():
+	#fold everything into a new snapshot and start an empty journal. the floors
+	#in the cache are packed here but written by the autosave thread, ahead of
+	#the snapshot, or the snapshot couldn't go back to them
+	global save_generation, journal_records
+	save_generation += 1
+	for (level, floor) in floor_cache.unsaved():
+		autosaver.submit('floor', (level, floor))
+	autosaver.submit('snapshot', encode_save())
+	journal_records = 0
+	checkpoint()
+
+def autosave():
+	#hand the changes since the last autosave to the writer thread
+	global journal_records
+	if autosaver is None:
+		return
+	if map is not checkpoint_map or journal_records >= JOURNAL_LIMIT:
+		#a whole new level, or a long journal: just take a new snapshot
+		compact_autosave()
+		return
+	
+	#newly explored tiles, found a row at a time
+	explored = bytes(map.explored)
+	w = map.width
+	newly_explored = []
+	for y in range(map.height):
+		row = slice(y * w, (y + 1) * w)
+		if explored[row] != checkpoint_explored[row]:
+			newly_explored.extend((i,) for i in range(y * w, (y + 1) * w) if explored[i] != checkpoint_explored[i])
+	
+	changed_on_map = []
+	changed_carried = []
+	for obj in objects:
+		if checkpoint_states.get(obj.oid) != object_state(obj):
+			changed_on_map.append(obj)
+	for obj in inventory:
+		if checkpoint_states.get(obj.oid) != object_state(obj):
+			changed_carried.append(obj)
+	
+	order = pack_columns('I', [(obj.oid,) for obj in objects]) + pack_columns('I', [(obj.oid,) for obj in inventory])
+	sections = [
+		encode_game(),
+		(b'EXPL', pack_columns('I', newly_explored)),
+		(b'ORDR', order),
+		encode_messages(),
+		] + encode_entities(changed_on_map, changed_carried)
+	record = pack_sections(map.width, map.height, sections)
+	autosaver.submit('record', struct.pack('<III', len(record), zlib.crc32(record) & 0xffffffff, save_generation) + record)
+	journal_records += 1
+	checkpoint()
+
+def read_journal(generation):
+	#the intact journal records that build on the given snapshot
+	records = []
+	if not os.path.exists(JOURNAL_FILE):
+		return records
+	with open(JOURNAL_FILE, 'rb') as file:
+		data = file.read()
+	offset = 0
+	header = struct.calcsize('<III')
+	while offset + header <= len(data):
+		(length, crc, record_generation) = struct.unpack_from('<III', data, offset)
+		record = data[offset + header:offset + header + length]
+		if len(record) < length or zlib.crc32(record) & 0xffffffff != crc:
+			break #the game died while writing this one
+		if record_generation == generation:
+			records.append(record)
+		offset += header + length
+	return records
 	
-libtcod.console_set_custom_font('prestige12x12_gs_tc.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
 
-libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'GEAR: WIZARD OF THE TECHNO NEXUS', False)
-libtcod.sys_set_fps(LIMIT_FPS)
-con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
 
-panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+#++++++++++++++RECORDINGS
+#a recording is the seed of a new game plus every key press and click the
+#player made, which is all it takes to play the same game again:
+#
+#	'GRPL' version seed map_width map_height
+#	zlib compressed table of (turn, kind, a, b)
+#
+#turn is how many turns had been taken when the input came in, so a replay
+#that stops matching its recording gets noticed straight away
+
+REPLAY_MAGIC = b'GRPL'
+REPLAY_VERSION = 2
+
+#the kinds of input, and what a and b are for them
+INPUT_KEY = 0 #a is a libtcod key code
+INPUT_CHAR = 1 #a is the character code
+INPUT_CLICK = 2 #a, b is the tile clicked
+INPUT_RCLICK = 3
+
+turn_count = 0 #player turns taken this game
+recording_file = None #set by --record
+
+def input_entry(key, mouse):
+	#the other way round from set_input: libtcod key and mouse state as a
+	#script entry, None if nothing happened
+	if mouse.lbutton_pressed:
+		return ('click', mouse.cx, mouse.cy)
+	if mouse.rbutton_pressed:
+		return ('rclick', mouse.cx, mouse.cy)
+	if key.vk == libtcod.KEY_CHAR:
+		return chr(key.c)
+	if key.vk != libtcod.KEY_NONE:
+		return key.vk
+	return None
+
+def encode_input(turn, entry):
+	if isinstance(entry, tuple):
+		(button, x, y) = entry
+		return (turn, INPUT_CLICK if button == 'click' else INPUT_RCLICK, x, y)
+	if isinstance(entry, str):
+		return (turn, INPUT_CHAR, ord(entry), 0)
+	return (turn, INPUT_KEY, entry, 0)
+
+def decode_input(kind, a, b):
+	if kind == INPUT_CLICK:
+		return ('click', a, b)
+	if kind == INPUT_RCLICK:
+		return ('rclick', a, b)
+	if kind == INPUT_CHAR:
+		return chr(a)
+	return a
+
+class Recorder:
+	#reads the keyboard and mouse like normal, but writes down every input
+	def __init__(self, seed):
+		self.seed = seed
+		self.rows = []
+		
+	def note(self, key, mouse):
+		entry = input_entry(key, mouse)
+		if entry is not None:
+			self.rows.append(encode_input(turn_count, entry))
+		
+	def poll(self, key, mouse, wait=False):
+		read_events(key, mouse, wait)
+		self.note(key, mouse)
+		
+	def wait_for_key(self):
+		key = libtcod.console_wait_for_keypress(True)
+		self.note(key, libtcod.Mouse())
+		return key
+		
+	def save(self, path):
+		header = struct.pack('<4sHIHH', REPLAY_MAGIC, REPLAY_VERSION, self.seed, MAP_WIDTH, MAP_HEIGHT)
+		write_file(path, header + zlib.compress(pack_columns('IBhh', self.rows)))
+		
+class ReplayInput(ScriptedInput):
+	#a recording played back. frames where nothing happened weren't recorded,
+	#so it runs as fast as the game can go
+	def __init__(self, rows):
+		ScriptedInput.__init__(self, [decode_input(kind, a, b) for (turn, kind, a, b) in rows])
+		self.turns = [turn for (turn, kind, a, b) in rows]
+		
+	def next(self):
+		if self.position < len(self.turns) and self.turns[self.position] != turn_count:
+			raise ValueError('replay went out of step with its recording at turn %d' % turn_count)
+		return ScriptedInput.next(self)
+
+def load_recording(path):
+	#returns (seed, ReplayInput)
+	with open(path, 'rb') as file:
+		data = file.read()
+	(magic, version, seed, width, height) = struct.unpack_from('<4sHIHH', data)
+	if magic != REPLAY_MAGIC:
+		raise ValueError('not a GEAR recording')
+	if version != REPLAY_VERSION:
+		raise ValueError('recording is version %d, this game reads version %d' % (version, REPLAY_VERSION))
+	if (width, height) != (MAP_WIDTH, MAP_HEIGHT):
+		raise ValueError('recording was made on a %dx%d map, not %dx%d' % (width, height, MAP_WIDTH, MAP_HEIGHT))
+	(rows, offset) = unpack_columns('IBhh', zlib.decompress(data[struct.calcsize('<4sHIHH'):]))
+	return (seed, ReplayInput(rows))
+
+def replay_game(path, render=False):
+	#play a recording back headless, menus, targeting and all. returns the
+	#seconds each player turn took
+	(seed, inputs) = load_recording(path)
+	new_game(seed)
+	timings = []
+	run_headless(inputs, len(inputs.inputs) + 1, render, timings)
+	return timings
+
+def report_replay(path):
+	start_headless()
+	timings = replay_game(path, render=True)
+	total = sum(timings)
+	print('%d turns in %.2f s, %.1f turns/sec' % (len(timings), total, len(timings) / max(total, 1e-9)))
+	slowest = sorted(range(len(timings)), key=lambda turn: timings[turn], reverse=True)[:10]
+	for turn in slowest:
+		print('turn %6d %8.2f ms' % (turn, timings[turn] * 1000.0))
+
+#main loop all up in dis
+#u don't even kno
+#this code be fresh and poppin
+def main():
+	global recording_file
+	parser = argparse.ArgumentParser(description='GEAR: Wizard of the Techno Nexus')
+	parser.add_argument('--record', metavar='FILE', help='record new games to FILE')
+	parser.add_argument('--replay', metavar='FILE', help='play FILE back without a window and time every turn')
+	args = parser.parse_args()
+	
+	if args.replay:
+		report_replay(args.replay)
+		return
+		
+	recording_file = args.record
+	init_window()
+	main_menu()
 
-main_menu()
+#importing GEAR doesn't open a window or touch the dice, only running it does
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,198 @@
+#benchmarks for GEAR. runs the game headless (no window) and reports how fast
+#turns, level generation, rendering and saving are:
+#
+#	python bench.py
+#	python bench.py --width 300 --height 200 --rooms 200 --monsters 8
+#	python bench.py --json results.json
+#	python bench.py --compare results.json
+#	python bench.py --replay session.grpl
+#
+#--compare exits with status 1 if any number got more than --tolerance worse
+#than the saved results, so it can be used to catch regressions. --replay also
+#times a recording made with 'python GEAR.py --record session.grpl'
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+import GEAR as game
+
+timer = timeit.default_timer
+
+
+def setup(args):
+	#resize the dungeon before anything gets allocated
+	game.MAP_WIDTH = args.width
+	game.MAP_HEIGHT = args.height
+	game.MAX_ROOMS = args.rooms
+	game.MAX_ROOM_MONSTERS = args.monsters
+	game.MAX_ROOM_ITEMS = args.items
+	game.MAP_GENERATOR = args.generator
+	game.start_headless()
+	game.new_game(args.seed)
+
+def bench_turns(args):
+	#player turns per second, with the monsters taking theirs after each one
+	taken = 0
+	games = 0
+	inputs = game.RandomInput(seed=args.seed)
+	start = timer()
+	while taken < args.turns:
+		taken += game.run_headless(inputs, args.turns - taken, render=False)
+		if game.game_state == 'dead':
+			games += 1
+			game.new_game(args.seed + games)
+	return taken / (timer() - start)
+
+def bench_levels(args):
+	#make_map() calls per second
+	start = timer()
+	for i in range(args.levels):
+		game.make_map()
+	elapsed = timer() - start
+	game.initialize_fov()
+	return args.levels / elapsed
+
+def bench_allocations(args):
+	#objects and components allocated per make_map(), once the previous
+	#level's objects can be reused
+	made = 0
+	for i in range(args.levels):
+		for obj in game.objects:
+			if obj is not game.player:
+				game.recycle(obj)
+		before = game.allocations
+		game.make_map()
+		made += game.allocations - before
+	game.initialize_fov()
+	return float(made) / args.levels
+
+def entity_bytes():
+	#average bytes held by a monster or item and its components
+	total = 0
+	count = 0
+	for obj in game.objects:
+		if obj is game.player:
+			continue
+		for part in (obj, obj.fighter, obj.ai, obj.item, obj.caster):
+			if part is None:
+				continue
+			total += sys.getsizeof(part)
+			if hasattr(part, '__dict__'):
+				total += sys.getsizeof(part.__dict__)
+		count += 1
+	return float(total) / max(count, 1)
+
+def bench_frames(args):
+	#render_all() calls per second, recomputing the FOV every frame like a
+	#player walking around would
+	game.render_all()
+	start = timer()
+	for i in range(args.frames):
+		game.recompute_fov()
+		game.render_all()
+	return args.frames / (timer() - start)
+
+def bench_saves(args):
+	#average milliseconds for save_game() and for load_game()
+	old_dir = os.getcwd()
+	work_dir = tempfile.mkdtemp()
+	os.chdir(work_dir)
+	try:
+		start = timer()
+		for i in range(args.saves):
+			game.save_game()
+		save_ms = (timer() - start) * 1000.0 / args.saves
+
+		start = timer()
+		for i in range(args.saves):
+			game.load_game()
+		load_ms = (timer() - start) * 1000.0 / args.saves
+	finally:
+		os.chdir(old_dir)
+		shutil.rmtree(work_dir)
+	return (save_ms, load_ms)
+
+def bench_replay(args):
+	#player turns per second playing a recorded game back
+	timings = game.replay_game(args.replay)
+	return len(timings) / sum(timings)
+
+def run(args):
+	results = {}
+	setup(args)
+	results['turns/sec'] = bench_turns(args)
+	results['levels/sec'] = bench_levels(args)
+	results['allocs/level'] = bench_allocations(args)
+	results['entity bytes'] = entity_bytes()
+	results['frames/sec'] = bench_frames(args)
+	try:
+		(results['save ms'], results['load ms']) = bench_saves(args)
+	except Exception as e:
+		print('save/load failed: %r' % e)
+	if args.replay:
+		results['replay turns/sec'] = bench_replay(args)
+	return results
+
+#for these, bigger is worse
+LOWER_IS_BETTER = ('save ms', 'load ms', 'allocs/level', 'entity bytes')
+
+def compare(results, baseline, tolerance):
+	#return the names of the numbers that got worse by more than tolerance
+	worse = []
+	for name in sorted(baseline):
+		if name not in results:
+			continue
+		if not baseline[name]:
+			continue
+		if name in LOWER_IS_BETTER:
+			change = (results[name] - baseline[name]) / baseline[name]
+		else:
+			change = (baseline[name] - results[name]) / baseline[name]
+		if change > tolerance:
+			worse.append(name)
+	return worse
+
+def main():
+	parser = argparse.ArgumentParser(description='Headless GEAR benchmarks.')
+	parser.add_argument('--width', type=int, default=game.MAP_WIDTH)
+	parser.add_argument('--height', type=int, default=game.MAP_HEIGHT)
+	parser.add_argument('--rooms', type=int, default=game.MAX_ROOMS)
+	parser.add_argument('--monsters', type=int, default=game.MAX_ROOM_MONSTERS, help='most monsters per room')
+	parser.add_argument('--items', type=int, default=game.MAX_ROOM_ITEMS, help='most items per room')
+	parser.add_argument('--generator', default=game.MAP_GENERATOR, choices=sorted(game.GENERATORS), help='how levels get built')
+	parser.add_argument('--seed', type=int, default=1, help='same seed, same dungeons and same key mashing')
+	parser.add_argument('--turns', type=int, default=2000)
+	parser.add_argument('--levels', type=int, default=50)
+	parser.add_argument('--frames', type=int, default=200)
+	parser.add_argument('--saves', type=int, default=10)
+	parser.add_argument('--replay', help='recording to play back as well')
+	parser.add_argument('--json', help='write the results to this file')
+	parser.add_argument('--compare', help='results file from an earlier run to check against')
+	parser.add_argument('--tolerance', type=float, default=0.2, help='how much worse counts as a regression (0.2 = 20%%)')
+	args = parser.parse_args()
+
+	results = run(args)
+
+	print('%s map %dx%d, %d rooms, up to %d monsters and %d items per room' % (args.generator, args.width, args.height, args.rooms, args.monsters, args.items))
+	for name in sorted(results):
+		print('%-16s %10.2f' % (name, results[name]))
+
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump(results, f, indent=1, sort_keys=True)
+
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+		worse = compare(results, baseline, args.tolerance)
+		if worse:
+			print('slower than ' + args.compare + ': ' + ', '.join(worse))
+			sys.exit(1)
+
+if __name__ == '__main__':
+	main()
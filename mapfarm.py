@@ -0,0 +1,151 @@
+#builds lots of levels on every CPU core and checks them, so a change to a
+#map generator can be tried on thousands of seeds without playing:
+#
+#	python mapfarm.py --levels 100000
+#	python mapfarm.py --generator cave --generator walk --levels 5000
+#	python mapfarm.py --width 300 --height 200 --report farm.json
+#
+#every level is checked for stairs the player can't walk to and for having
+#fewer than --min-areas rooms (or areas). the summary has timings, room counts
+#and how crowded the levels are for each generator. exits with status 1 if any
+#level failed a check
+
+import argparse
+import json
+import multiprocessing
+import sys
+import timeit
+
+import GEAR as game
+
+timer = timeit.default_timer
+
+min_areas = 2
+
+
+def setup(settings, fewest_areas):
+	#runs once in every worker
+	global min_areas
+	for (name, value) in settings.items():
+		setattr(game, name, value)
+	min_areas = fewest_areas
+
+def build_level(task):
+	#make one level and measure it. runs in a worker
+	(generator, seed, level) = task
+	game.MAP_GENERATOR = generator
+	game.game_seed = seed
+	game.dungeon_level = level
+	game.player = game.Object(0, 0, '@', 'player', game.libtcod.white, blocks=True)
+	try:
+		game.make_map()
+	except Exception as e:
+		return {'generator': generator, 'seed': seed, 'failed': 'crashed: %r' % e}
+		
+	map = game.map
+	size = map.width * map.height
+	floor = size - map.blocked.count(b'\x01')
+	reached = bytearray(size)
+	connected = game.connectivity(reached)
+	(name, seconds, areas) = game.generation_report
+	result = {
+		'generator': generator,
+		'seed': seed,
+		'ms': seconds * 1000.0,
+		'areas': areas,
+		'floor': float(floor) / size,
+		'connectivity': connected,
+		'monsters': 100.0 * len([obj for obj in game.objects if obj.fighter]) / max(floor, 1),
+		'items': 100.0 * len([obj for obj in game.objects if obj.item]) / max(floor, 1),
+		}
+	if not reached[game.stairs.x + game.stairs.y * map.width]:
+		result['failed'] = 'stairs unreachable'
+	elif areas < min_areas:
+		result['failed'] = 'only %d areas' % areas
+	return result
+
+def percentile(values, fraction):
+	values = sorted(values)
+	return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def summarize(results):
+	#one summary per generator
+	summary = {}
+	for generator in sorted(set(r['generator'] for r in results)):
+		mine = [r for r in results if r['generator'] == generator]
+		built = [r for r in mine if 'ms' in r]
+		failed = sorted((r for r in mine if 'failed' in r), key=lambda r: r['seed'])
+		entry = {'levels': len(mine), 'failed': len(failed),
+			'failures': [(r['seed'], r['failed']) for r in failed[:20]]}
+		if built:
+			times = [r['ms'] for r in built]
+			entry.update({
+				'ms mean': sum(times) / len(times),
+				'ms p50': percentile(times, 0.5),
+				'ms p95': percentile(times, 0.95),
+				'ms max': max(times),
+				'areas mean': float(sum(r['areas'] for r in built)) / len(built),
+				'areas min': min(r['areas'] for r in built),
+				'areas max': max(r['areas'] for r in built),
+				'floor mean': sum(r['floor'] for r in built) / len(built),
+				'connectivity min': min(r['connectivity'] for r in built),
+				'connectivity mean': sum(r['connectivity'] for r in built) / len(built),
+				'monsters per 100 floor': sum(r['monsters'] for r in built) / len(built),
+				'items per 100 floor': sum(r['items'] for r in built) / len(built),
+				})
+		summary[generator] = entry
+	return summary
+
+def main():
+	parser = argparse.ArgumentParser(description='Build and check GEAR levels in bulk.')
+	parser.add_argument('--levels', type=int, default=1000, help='levels per generator')
+	parser.add_argument('--generator', action='append', choices=sorted(game.GENERATORS), help='can be given more than once (default: %s)' % game.MAP_GENERATOR)
+	parser.add_argument('--first-seed', type=int, default=1, help='levels use this seed and the ones after it')
+	parser.add_argument('--level', type=int, default=1, help='which floor of the dungeon to build')
+	parser.add_argument('--width', type=int, default=game.MAP_WIDTH)
+	parser.add_argument('--height', type=int, default=game.MAP_HEIGHT)
+	parser.add_argument('--rooms', type=int, default=game.MAX_ROOMS)
+	parser.add_argument('--monsters', type=int, default=game.MAX_ROOM_MONSTERS, help='most monsters per room')
+	parser.add_argument('--items', type=int, default=game.MAX_ROOM_ITEMS, help='most items per room')
+	parser.add_argument('--min-areas', type=int, default=2, help='fewer rooms (or areas) than this counts as a failure')
+	parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+	parser.add_argument('--report', help='write the summary to this file as JSON')
+	args = parser.parse_args()
+	
+	generators = args.generator or [game.MAP_GENERATOR]
+	settings = {'MAP_WIDTH': args.width, 'MAP_HEIGHT': args.height, 'MAX_ROOMS': args.rooms,
+		'MAX_ROOM_MONSTERS': args.monsters, 'MAX_ROOM_ITEMS': args.items}
+	setup(settings, args.min_areas)
+	tasks = [(generator, seed, args.level) for generator in generators
+		for seed in range(args.first_seed, args.first_seed + args.levels)]
+	
+	start = timer()
+	pool = multiprocessing.Pool(args.workers, setup, (settings, args.min_areas))
+	try:
+		results = list(pool.imap_unordered(build_level, tasks, chunksize=max(1, len(tasks) // (args.workers * 16))))
+	finally:
+		pool.close()
+		pool.join()
+	elapsed = timer() - start
+	
+	summary = summarize(results)
+	print('%d levels in %.1f s on %d workers, %dx%d map' % (len(results), elapsed, args.workers, args.width, args.height))
+	for generator in sorted(summary):
+		entry = summary[generator]
+		print('')
+		print(generator)
+		for name in sorted(entry):
+			if name != 'failures':
+				print('  %-24s %10.3f' % (name, entry[name]))
+		for (seed, reason) in entry['failures']:
+			print('  seed %d: %s' % (seed, reason))
+			
+	if args.report:
+		with open(args.report, 'w') as f:
+			json.dump({'settings': settings, 'level': args.level, 'min areas': args.min_areas, 'seconds': elapsed, 'generators': summary}, f, indent=1, sort_keys=True)
+			
+	if any(entry['failed'] for entry in summary.values()):
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,54 @@
+#shared setup for the tests. they need libtcodpy next to GEAR.py, like the game
+#itself does, but never open a window
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import GEAR as game
+
+
+@pytest.fixture
+def headless(tmpdir):
+	#a game without a window, writing its save files into a fresh directory
+	old_dir = tmpdir.chdir()
+	game.start_headless()
+	yield game
+	game.stop_autosave()
+	old_dir.chdir()
+
+def describe(obj):
+	#everything about an object that a save has to keep
+	fighter = obj.fighter and (obj.fighter.hp, obj.fighter.max_hp, obj.fighter.defense, obj.fighter.power,
+		obj.fighter.energy, obj.fighter.speed, obj.fighter.death_function.__name__)
+	ai = obj.ai and (obj.ai.__class__.__name__, getattr(obj.ai, 'num_turns', None))
+	item = obj.item and (obj.item.use_function.__name__, obj.item.multi_use)
+	return (obj.oid, obj.x, obj.y, obj.char, obj.name, obj.blocks,
+		(obj.color.r, obj.color.g, obj.color.b), fighter, ai, item)
+
+@pytest.fixture
+def snapshot():
+	#returns a function that describes the whole game, for comparing two games.
+	#oids keep counting up from one game to the next, so a game played again
+	#from the start is compared with oids=False
+	def take(oids=True):
+		def strip(obj):
+			if oids:
+				return describe(obj)
+			return describe(obj)[1:]
+		return {
+			'objects': [strip(obj) for obj in game.objects],
+			'inventory': [strip(obj) for obj in game.inventory],
+			'player': game.objects.index(game.player),
+			'stairs': game.objects.index(game.stairs),
+			'level': game.dungeon_level,
+			'distortion': game.distortion,
+			'state': game.game_state,
+			'blocked': bytes(game.map.blocked),
+			'explored': bytes(game.map.explored),
+			'messages': [(line, (color.r, color.g, color.b)) for (line, color) in game.game_msgs],
+			}
+	return take
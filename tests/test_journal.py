@@ -0,0 +1,103 @@
+#autosaves: after a crash the game comes back as of the last intact journal record
+
+import struct
+
+import pytest
+
+#walking around only, so the player stays on the first floor and every
+#autosave is a journal record rather than a new snapshot
+WALKING = ['up', 'down', 'left', 'right']
+
+def record_offsets(data):
+	#where each record of a journal starts
+	header = struct.calcsize('<III')
+	offsets = []
+	offset = 0
+	while offset + header <= len(data):
+		(length, crc, generation) = struct.unpack_from('<III', data, offset)
+		offsets.append(offset)
+		offset += header + length
+	return offsets
+
+@pytest.fixture
+def crashed(headless, snapshot):
+	#play with autosaves on, then stop without saving like a crash would.
+	#returns what the game looked like at each autosave
+	game = headless
+	keys = [getattr(game.libtcod, 'KEY_' + name.upper()) for name in WALKING]
+	game.new_game(2)
+	game.start_autosave()
+	inputs = game.RandomInput(keys=keys, seed=2)
+	states = []
+	for n in range(3):
+		game.run_headless(inputs, 15, render=False)
+		game.autosave()
+		states.append(snapshot())
+	game.stop_autosave()
+	assert game.game_state == 'playing'
+	return states
+
+def change_journal(game, change):
+	with open(game.JOURNAL_FILE, 'rb') as file:
+		data = bytearray(file.read())
+	data = change(data)
+	with open(game.JOURNAL_FILE, 'wb') as file:
+		file.write(data)
+
+def test_recovers_every_autosave(headless, snapshot, crashed):
+	game = headless
+	assert crashed[-1] != crashed[-2] #the player really did move in between
+	with open(game.JOURNAL_FILE, 'rb') as file:
+		assert len(record_offsets(file.read())) == len(crashed)
+	game.load_game()
+	assert snapshot() == crashed[-1]
+
+def test_record_cut_short_is_ignored(headless, snapshot, crashed):
+	game = headless
+	def cut(data):
+		last = record_offsets(bytes(data))[-1]
+		return data[:last + (len(data) - last) // 2]
+	change_journal(game, cut)
+	game.load_game()
+	assert snapshot() == crashed[-2]
+
+def test_corrupt_record_is_ignored(headless, snapshot, crashed):
+	game = headless
+	def corrupt(data):
+		data[-1] ^= 0xff
+		return data
+	change_journal(game, corrupt)
+	game.load_game()
+	assert snapshot() == crashed[-2]
+
+def test_journal_from_an_older_snapshot_is_ignored(headless, snapshot, crashed):
+	game = headless
+	with open(game.JOURNAL_FILE, 'rb') as file:
+		journal = file.read()
+	game.load_game()
+	game.save_game() #a newer snapshot, which removes the journal
+	saved = snapshot()
+	with open(game.JOURNAL_FILE, 'wb') as file:
+		file.write(journal)
+	game.load_game()
+	assert snapshot() == saved
+
+def test_floors_left_before_a_crash_come_back(headless, snapshot):
+	game = headless
+	game.new_game(7)
+	game.start_autosave()
+	monster = [obj for obj in game.objects if obj.fighter and obj is not game.player][0]
+	monster.fighter.take_damage(1000)
+	item = [obj for obj in game.objects if obj.item][0]
+	item.item.pick_up()
+	player = game.player.oid
+	first_floor = [obj for obj in snapshot()['objects'] if obj[0] != player]
+	game.next_level()
+	game.autosave() #a new level, so a new snapshot with the first floor beside it
+	game.stop_autosave()
+
+	game.load_game()
+	assert game.dungeon_level == 2
+	game.previous_level()
+	assert [obj for obj in snapshot()['objects'] if obj[0] != player] == first_floor
+	assert (game.player.x, game.player.y) == (game.stairs.x, game.stairs.y)
@@ -0,0 +1,63 @@
+#recordings: a recorded game played back ends up exactly where the original did
+
+import pytest
+
+
+class Taped(object):
+	#random key mashing that also goes into a Recorder, the way the keyboard
+	#does in a real game
+	def __init__(self, game, seed):
+		self.game = game
+		self.inputs = game.RandomInput(seed=seed)
+		self.recorder = game.Recorder(game.game_seed)
+
+	def poll(self, key, mouse, wait=False):
+		self.inputs.poll(key, mouse)
+		self.recorder.note(key, mouse)
+
+	def wait_for_key(self):
+		key = self.inputs.wait_for_key()
+		self.recorder.note(key, self.game.libtcod.Mouse())
+		return key
+
+def record(game, seed, turns, path):
+	#play a new game and write its recording to path. returns the turns taken
+	game.new_game(seed)
+	taped = Taped(game, seed)
+	taken = game.run_headless(taped, turns, render=False)
+	taped.recorder.save(str(path))
+	return taken
+
+@pytest.mark.parametrize('seed', [3, 4])
+def test_replay_matches_the_recorded_game(headless, snapshot, tmpdir, seed):
+	game = headless
+	path = tmpdir.join('game.grpl')
+	taken = record(game, seed, 500, path)
+	recorded = snapshot(oids=False)
+	recorded_turns = game.turn_count
+
+	timings = game.replay_game(str(path))
+	assert len(timings) == taken
+	assert game.turn_count == recorded_turns
+	assert snapshot(oids=False) == recorded
+
+def test_recording_remembers_the_game(headless, tmpdir):
+	game = headless
+	path = tmpdir.join('game.grpl')
+	record(game, 7, 50, path)
+	(seed, inputs) = game.load_recording(str(path))
+	assert seed == game.game_seed
+	assert len(inputs.inputs) > 0
+
+def test_replay_out_of_step_is_noticed(headless, tmpdir):
+	game = headless
+	game.new_game(3)
+	taped = Taped(game, 3)
+	game.run_headless(taped, 300, render=False)
+	rows = taped.recorder.rows
+	(turn, kind, a, b) = rows[5]
+	rows[5] = (turn + 7, kind, a, b)
+	path = tmpdir.join('bad.grpl')
+	taped.recorder.save(str(path))
+	with pytest.raises(ValueError):
+		game.replay_game(str(path))
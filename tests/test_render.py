@@ -0,0 +1,57 @@
+#rendering: the distortion flicker has to look the way it always has
+
+import random
+
+import pytest
+
+import GEAR as game
+
+
+def tile_code(explored, block_sight, in_view, i):
+	return explored[i] and 1 + block_sight[i] + 2 * in_view[i]
+
+def flickers_tile_by_tile(hits, explored, block_sight, in_view, spaced):
+	#the rule as the game first had it: go over every tile of the map, and in
+	#the normal palette a hit tile doesn't flicker if the last tile of the
+	#same kind did
+	hit = set(hits)
+	position = dict((i, n) for (n, i) in enumerate(hits))
+	flickered = [False] * 5
+	found = []
+	for i in range(len(explored)):
+		code = tile_code(explored, block_sight, in_view, i)
+		if not code:
+			continue
+		flickers = i in hit and not (spaced and flickered[code])
+		flickered[code] = flickers
+		if flickers:
+			found.append((position[i], code))
+	return found
+
+def random_frame(rng, size, chance):
+	explored = bytearray(rng.random() < 0.6 for i in range(size))
+	block_sight = bytearray(rng.random() < 0.4 for i in range(size))
+	in_view = bytearray(rng.random() < 0.1 for i in range(size))
+	hits = [i for i in range(size) if rng.random() < chance]
+	return (hits, explored, block_sight, in_view)
+
+@pytest.mark.parametrize('chance', [0.01, 0.1, 0.5])
+@pytest.mark.parametrize('spaced', [True, False])
+def test_flicker_matches_the_tile_by_tile_rule(chance, spaced):
+	rng = random.Random(4)
+	for frame in range(50):
+		(hits, explored, block_sight, in_view) = random_frame(rng, 2000, chance)
+		expected = flickers_tile_by_tile(hits, explored, block_sight, in_view, spaced)
+		assert game.pick_flickers(hits, explored, block_sight, in_view, spaced) == expected
+
+def test_sparse_hits_flicker_as_often_as_before():
+	#with few hits, almost every hit has some tile of its kind in between, so
+	#nearly all of them flicker
+	rng = random.Random(7)
+	hit_count = 0
+	flicker_count = 0
+	for frame in range(200):
+		(hits, explored, block_sight, in_view) = random_frame(rng, 6800, 0.01)
+		hit_count += len([i for i in hits if tile_code(explored, block_sight, in_view, i)])
+		flicker_count += len(game.pick_flickers(hits, explored, block_sight, in_view, True))
+	assert flicker_count > 0.95 * hit_count
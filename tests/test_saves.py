@@ -0,0 +1,57 @@
+#save files: a saved game has to come back exactly as it was
+
+import os
+
+import pytest
+
+
+def test_save_and_load_round_trip(headless, snapshot):
+	game = headless
+	game.new_game(5)
+	game.run_headless(game.RandomInput(seed=5), 300, render=False)
+	saved = snapshot()
+	game.save_game()
+
+	game.new_game(6)
+	assert snapshot() != saved
+	game.load_game()
+	assert snapshot() == saved
+
+def test_visited_floors_survive_a_save(headless, snapshot):
+	game = headless
+	game.new_game(3)
+	player = game.player.oid
+	first_floor = [obj for obj in snapshot()['objects'] if obj[0] != player]
+	game.next_level()
+	game.save_game()
+	assert os.path.exists(game.floor_path(1))
+
+	game.load_game()
+	game.previous_level()
+	assert [obj for obj in snapshot()['objects'] if obj[0] != player] == first_floor
+	assert (game.player.x, game.player.y) == (game.stairs.x, game.stairs.y)
+
+def test_save_from_another_version_is_refused(headless):
+	game = headless
+	game.new_game(1)
+	game.save_game()
+	with open(game.SAVE_FILE, 'rb') as file:
+		data = bytearray(file.read())
+	data[4] ^= 0xff #the version, right after 'GEAR'
+	with open(game.SAVE_FILE, 'wb') as file:
+		file.write(data)
+	with pytest.raises(ValueError):
+		game.load_game()
+
+def test_headless_games_leave_saved_floors_alone(headless):
+	#bench.py and replays start new games without a window, maybe right next
+	#to the player's save
+	game = headless
+	os.makedirs('savegame.floors')
+	with open(os.path.join('savegame.floors', 'level1.sav'), 'wb') as file:
+		file.write(b'saved floor')
+	game.new_game(2)
+	game.next_level()
+	game.save_game()
+	with open(os.path.join('savegame.floors', 'level1.sav'), 'rb') as file:
+		assert file.read() == b'saved floor'
@@ -0,0 +1,69 @@
+#looking and aiming across the map without a FOV map, and the spatial index
+#queries that spells aim with
+
+import pytest
+
+import GEAR as game
+
+
+@pytest.fixture
+def room(monkeypatch):
+	#an open 20x20 room with a single wall tile at (10, 5)
+	room = game.Map(20, 20)
+	room.carve_rect(1, 1, 18, 18)
+	room.blocked[room.index(10, 5)] = 1
+	room.block_sight[room.index(10, 5)] = 1
+	monkeypatch.setattr(game, 'map', room)
+	return room
+
+def test_line_points_cover_both_ends():
+	assert game.line_points(2, 3, 6, 3) == [(2, 3), (3, 3), (4, 3), (5, 3), (6, 3)]
+	assert game.line_points(5, 5, 2, 2) == [(5, 5), (4, 4), (3, 3), (2, 2)]
+	points = game.line_points(1, 1, 8, 4)
+	assert (points[0], points[-1]) == ((1, 1), (8, 4))
+	for ((x1, y1), (x2, y2)) in zip(points, points[1:]):
+		assert max(abs(x2 - x1), abs(y2 - y1)) == 1
+
+def test_open_line_is_seen(room):
+	assert game.line_of_sight(3, 3, 8, 7)
+	assert game.line_of_sight(10, 2, 10, 4)
+
+def test_wall_in_between_blocks_sight(room):
+	assert not game.line_of_sight(10, 2, 10, 8)
+	assert not game.line_of_sight(6, 5, 14, 5)
+	#the wall itself can be seen, it just hides what is behind it
+	assert game.line_of_sight(10, 2, 10, 5)
+
+def test_nothing_is_seen_beyond_the_radius(room):
+	assert not game.line_of_sight(1, 10, 1 + game.TORCH_RADIUS + 1, 10)
+	assert game.line_of_sight(1, 10, 1 + game.TORCH_RADIUS, 10)
+	assert game.line_of_sight(1, 10, 15, 10, radius=0)
+
+def scatter(positions):
+	#an index with a rock on each of the given tiles, in that order
+	index = game.SpatialIndex()
+	rocks = [game.Object(x, y, '*', 'rock', game.libtcod.white) for (x, y) in positions]
+	for rock in rocks:
+		index.add(rock)
+	return (index, rocks)
+
+def test_cone_takes_what_is_in_front(room):
+	(index, rocks) = scatter([(9, 10), (8, 12), (9, 7), (2, 10), (5, 14), (6, 13), (15, 10)])
+	(ahead, inside, other_side, behind, square_on, too_wide, out_of_reach) = rocks
+	#aiming right from (5, 10), 45 degrees either way, 6 tiles long
+	found = index.in_cone(5, 10, 12, 10, 6, 45)
+	assert found == [ahead, inside, other_side]
+	assert behind not in found and square_on not in found
+	assert too_wide not in found and out_of_reach not in found
+
+def test_narrow_cone_is_narrow(room):
+	(index, (ahead, inside)) = scatter([(9, 10), (8, 12)])
+	assert index.in_cone(5, 10, 12, 10, 6, 10) == [ahead]
+
+def test_line_is_in_the_order_a_bolt_hits(room):
+	(index, (far, near, off)) = scatter([(8, 3), (4, 3), (5, 4)])
+	assert index.on_line(2, 3, 15, 3) == [near, far]
+
+def test_line_stops_at_the_first_wall(room):
+	(index, (before, behind)) = scatter([(10, 3), (10, 8)])
+	assert index.on_line(10, 1, 10, 15) == [before]